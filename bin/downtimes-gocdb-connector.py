@@ -44,12 +44,23 @@ DOWNTIMEPI = '/gocdbpi/private/?method=get_downtime'
 globopts = {}
 
 
-def getText(nodelist):
-    rc = []
-    for node in nodelist:
-        if node.nodeType == node.TEXT_NODE:
-            rc.append(node.data)
-    return ''.join(rc)
+def getChildText(elem, tag):
+    return elem.find(tag).text or ''
+
+
+def downtime_record(downtime):
+    if downtime.find('PRIMARY_KEY') is not None:
+        serviceId = getChildText(downtime, 'PRIMARY_KEY')
+    else:
+        serviceId = downtime.get('PRIMARY_KEY', '')
+
+    return {'classification': downtime.attrib['CLASSIFICATION'],
+            'hostname': getChildText(downtime, 'HOSTNAME'),
+            'service_type': getChildText(downtime, 'SERVICE_TYPE'),
+            'start': getChildText(downtime, 'FORMATED_START_DATE'),
+            'end': getChildText(downtime, 'FORMATED_END_DATE'),
+            'severity': getChildText(downtime, 'SEVERITY'),
+            'service_id': serviceId}
 
 
 def all_same(elemlist):
@@ -78,39 +89,33 @@ class GOCDBReader(object):
         filteredDowntimes = list()
 
         try:
-            res = input.connection(logger, module_class_name(self), globopts, self._o.scheme, self._o.netloc,
-                                   DOWNTIMEPI + '&windowstart=%s&windowend=%s' % (start.strftime(self.argDateFormat),
-                                                                                  end.strftime(self.argDateFormat)),
-                                   custauth=self.custauth)
-            if not res:
-                raise input.ConnectorError()
-
-            doc = input.parse_xml(logger, module_class_name(self), globopts,
-                                  res, self._o.scheme + '://' + self._o.netloc + DOWNTIMEPI)
+            url = DOWNTIMEPI + '&windowstart=%s&windowend=%s' % (start.strftime(self.argDateFormat),
+                                                                 end.strftime(self.argDateFormat))
 
-            if not doc:
-                raise input.ConnectorError()
+            def fetch():
+                res = input.connection(logger, module_class_name(self), globopts, self._o.scheme, self._o.netloc,
+                                       url, custauth=self.custauth, stream=True)
+                if not res:
+                    raise input.ConnectorError()
 
-        except input.ConnectorError:
-            self.state = False
-            return []
+                return list(input.parse_xml_records(logger, module_class_name(self), globopts,
+                                                    res, self._o.scheme + '://' + self._o.netloc + DOWNTIMEPI,
+                                                    'DOWNTIME', downtime_record))
 
-        else:
-            downtimes = doc.getElementsByTagName('DOWNTIME')
             try:
+                # jobs with different TopoUIDServiceEndpoints read the same feed
+                downtimes = input.single_flight(input.request_key(globopts, self._o.scheme, self._o.netloc,
+                                                                  url, self.custauth),
+                                                lambda: input.fetch_streamed(logger, module_class_name(self),
+                                                                             globopts, fetch))
                 for downtime in downtimes:
-                    classification = downtime.getAttributeNode('CLASSIFICATION').nodeValue
-                    hostname = getText(downtime.getElementsByTagName('HOSTNAME')[0].childNodes)
-                    serviceType = getText(downtime.getElementsByTagName('SERVICE_TYPE')[0].childNodes)
-                    startStr = getText(downtime.getElementsByTagName('FORMATED_START_DATE')[0].childNodes)
-                    endStr = getText(downtime.getElementsByTagName('FORMATED_END_DATE')[0].childNodes)
-                    severity = getText(downtime.getElementsByTagName('SEVERITY')[0].childNodes)
-                    try:
-                        serviceId = getText(downtime.getElementsByTagName('PRIMARY_KEY')[0].childNodes)
-                    except IndexError:
-                        serviceId = downtime.getAttribute('PRIMARY_KEY')
-                    startTime = datetime.datetime.strptime(startStr, self.WSDateFormat)
-                    endTime = datetime.datetime.strptime(endStr, self.WSDateFormat)
+                    classification = downtime['classification']
+                    hostname = downtime['hostname']
+                    serviceType = downtime['service_type']
+                    severity = downtime['severity']
+                    serviceId = downtime['service_id']
+                    startTime = datetime.datetime.strptime(downtime['start'], self.WSDateFormat)
+                    endTime = datetime.datetime.strptime(downtime['end'], self.WSDateFormat)
 
                     if (startTime < start):
                         startTime = start
@@ -137,6 +142,10 @@ class GOCDBReader(object):
             else:
                 return filteredDowntimes
 
+        except input.ConnectorError:
+            self.state = False
+            return []
+
 
 def main():
     global logger, globopts
@@ -235,6 +244,11 @@ def main():
             if not gocdb.state:
                 continue
 
+            # dts can be shared between jobs so encoded data is kept aside
+            dtsout = dts
+            if eval(globopts['GeneralPublishAms'.lower()]) and eval(globopts['GeneralWriteAvro'.lower()]):
+                dtsout = output.AvroData(globopts['AvroSchemasDowntimes'.lower()], dts)
+
             if eval(globopts['GeneralPublishAms'.lower()]):
                 ams = output.AmsPublish(ams_opts['amshost'],
                                         ams_opts['amsproject'],
@@ -245,15 +259,19 @@ def main():
                                         ams_opts['amspacksinglemsg'],
                                         logger,
                                         int(globopts['ConnectionRetry'.lower()]),
-                                        int(globopts['ConnectionTimeout'.lower()]))
+                                        int(globopts['ConnectionTimeout'.lower()]),
+                                        bulkbytes=ams_opts.get('AmsBulkBytes'.lower(), output.AMSBULKBYTES),
+                                        maxinflight=ams_opts.get('AmsMaxInFlight'.lower(), output.AMSMAXINFLIGHT),
+                                        statedir=jobstatedir,
+                                        savedays=globopts['InputStateDays'.lower()])
 
                 ams.send(globopts['AvroSchemasDowntimes'.lower()], 'downtimes',
-                         timestamp.replace('_', '-'), dts)
+                         timestamp.replace('_', '-'), dtsout)
 
             if eval(globopts['GeneralWriteAvro'.lower()]):
                 filename = filename_date(logger, globopts['OutputDowntimes'.lower()], jobdir, stamp=timestamp)
                 avro = output.AvroWriter(globopts['AvroSchemasDowntimes'.lower()], filename)
-                ret, excep = avro.write(dts)
+                ret, excep = avro.write(dtsout)
                 if not ret:
                     logger.error('Customer:%s Job:%s %s' % (logger.customer, logger.job, repr(excep)))
                     raise SystemExit(1)
@@ -0,0 +1 @@
+downtimes-gocdb-connector.py
\ No newline at end of file
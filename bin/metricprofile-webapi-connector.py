@@ -188,6 +188,9 @@ def main():
             if not webapi.state:
                 continue
 
+            if eval(globopts['GeneralPublishAms'.lower()]) and eval(globopts['GeneralWriteAvro'.lower()]):
+                fetched_profiles = output.AvroData(globopts['AvroSchemasMetricProfile'.lower()], fetched_profiles)
+
             if eval(globopts['GeneralPublishAms'.lower()]):
                 if fixed_date:
                     partdate = fixed_date
@@ -203,7 +206,11 @@ def main():
                                         ams_opts['amspacksinglemsg'],
                                         logger,
                                         int(globopts['ConnectionRetry'.lower()]),
-                                        int(globopts['ConnectionTimeout'.lower()]))
+                                        int(globopts['ConnectionTimeout'.lower()]),
+                                        bulkbytes=ams_opts.get('AmsBulkBytes'.lower(), output.AMSBULKBYTES),
+                                        maxinflight=ams_opts.get('AmsMaxInFlight'.lower(), output.AMSMAXINFLIGHT),
+                                        statedir=jobstatedir,
+                                        savedays=globopts['InputStateDays'.lower()])
 
                 ams.send(globopts['AvroSchemasMetricProfile'.lower()], 'metric_profile',
                          partdate, fetched_profiles)
@@ -0,0 +1 @@
+metricprofile-webapi-connector.py
\ No newline at end of file
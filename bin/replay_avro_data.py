@@ -0,0 +1 @@
+replay-avro-data.py
\ No newline at end of file
@@ -3,7 +3,6 @@
 import argparse
 import os
 import sys
-import json
 
 from urlparse import urlparse
 
@@ -12,6 +11,16 @@ from argo_egi_connectors import output
 from argo_egi_connectors.log import Logger
 from argo_egi_connectors.config import Global, CustomerConf
 from argo_egi_connectors.helpers import filename_date, datestamp, date_check
+from argo_egi_connectors.helpers import GroupOfEndpoints, GroupOfGroups
+
+
+ENTITY_FIELDS = ('SITENAME-SERVICEGROUP', 'SERVICE_TYPE', 'URL', 'Service Unique ID')
+GROUPTAGS = ('monitored', 'scope')
+ENDPOINTTAGS = ('scope', 'monitored', 'info.URL')
+
+
+def entity_fields(entity):
+    return dict((f, entity[f]) for f in ENTITY_FIELDS if f in entity)
 
 
 def is_feed(feed):
@@ -23,6 +32,38 @@ def is_feed(feed):
         return True
 
 
+def fetch_entities(logger, globopts, feed):
+    if is_feed(feed):
+        remote_topo = urlparse(feed)
+
+        def fetch():
+            res = input.connection(logger, 'EOSC', globopts, remote_topo.scheme, remote_topo.netloc, remote_topo.path,
+                                   stream=True)
+            if not res:
+                raise input.ConnectorError()
+
+            doc = input.parse_json_records(logger, 'EOSC', globopts, res,
+                                           remote_topo.scheme + '://' +
+                                           remote_topo.netloc + remote_topo.path,
+                                           entity_fields)
+            return list(doc)
+
+        return input.fetch_streamed(logger, 'EOSC', globopts, fetch)
+    else:
+        with open(feed) as fp:
+            js = input.parse_json_records(logger, 'EOSC', globopts, fp,
+                                          feed, entity_fields)
+            return list(js)
+
+
+def feed_key(globopts, feed):
+    if is_feed(feed):
+        remote_topo = urlparse(feed)
+        return input.request_key(globopts, remote_topo.scheme, remote_topo.netloc, remote_topo.path)
+    else:
+        return ('file', os.path.abspath(feed))
+
+
 class EOSCReader(object):
     def __init__(self, data, uidservtype=False, fetchtype='ServiceGroups'):
         self.data = data
@@ -36,14 +77,10 @@ class EOSCReader(object):
         groups = list()
 
         for entity in self.data:
-            tmp_dict = dict()
-
-            tmp_dict['type'] = 'PROJECT'
-            tmp_dict['group'] = 'EOSC'
-            tmp_dict['subgroup'] = entity['SITENAME-SERVICEGROUP']
-            tmp_dict['tags'] = {'monitored': '1', 'scope': 'EOSC'}
-
-            groups.append(tmp_dict)
+            groups.append(GroupOfGroups(GROUPTAGS, ('1', 'EOSC'),
+                                        type='PROJECT',
+                                        group='EOSC',
+                                        subgroup=entity['SITENAME-SERVICEGROUP']))
 
         return groups
 
@@ -51,19 +88,17 @@ class EOSCReader(object):
         groups = list()
 
         for entity in self.data:
-            tmp_dict = dict()
-
-            tmp_dict['type'] = self.fetchtype.upper()
-            tmp_dict['group'] = entity['SITENAME-SERVICEGROUP']
-            tmp_dict['service'] = entity['SERVICE_TYPE']
             info_url = entity['URL']
             if self.uidservtype:
-                tmp_dict['hostname'] = '{1}_{0}'.format(entity['Service Unique ID'], self._construct_fqdn(info_url))
+                hostname = '{1}_{0}'.format(entity['Service Unique ID'], self._construct_fqdn(info_url))
             else:
-                tmp_dict['hostname'] = self._construct_fqdn(entity['URL'])
-            tmp_dict['tags'] = {'scope': 'EOSC', 'monitored': '1', 'info.URL': info_url}
+                hostname = self._construct_fqdn(entity['URL'])
 
-            groups.append(tmp_dict)
+            groups.append(GroupOfEndpoints(ENDPOINTTAGS, ('EOSC', '1', info_url),
+                                           type=self.fetchtype.upper(),
+                                           group=entity['SITENAME-SERVICEGROUP'],
+                                           service=entity['SERVICE_TYPE'],
+                                           hostname=hostname))
 
         return groups
 
@@ -90,6 +125,7 @@ def main():
     confcust.parse()
     confcust.make_dirstruct()
     confcust.make_dirstruct(globopts['InputStateSaveDir'.lower()])
+    feeds = confcust.get_mapfeedjobs(sys.argv[0])
 
     for cust in confcust.get_customers():
         custname = confcust.get_custname(cust)
@@ -109,31 +145,20 @@ def main():
             ams_opts = cglob.merge_opts(ams_custopts, 'ams')
             ams_complete, missopt = cglob.is_complete(ams_opts, 'ams')
 
-            feeds = confcust.get_mapfeedjobs(sys.argv[0])
-            if is_feed(feeds.keys()[0]):
-                remote_topo = urlparse(feeds.keys()[0])
-                res = input.connection(logger, 'EOSC', globopts, remote_topo.scheme, remote_topo.netloc, remote_topo.path)
-                if not res:
-                    raise input.ConnectorError()
-
-                doc = input.parse_json(logger, 'EOSC', globopts, res,
-                                       remote_topo.scheme + '://' +
-                                       remote_topo.netloc + remote_topo.path)
-                eosc = EOSCReader(doc, uidservtype, fetchtype)
+            feed = feeds.keys()[0]
+            try:
+                # feed is fetched and parsed only for the first job
+                entities = input.single_flight(feed_key(globopts, feed),
+                                               lambda: fetch_entities(logger, globopts, feed))
+                eosc = EOSCReader(entities, uidservtype, fetchtype)
                 group_groups = eosc.get_groupgroups()
                 group_endpoints = eosc.get_groupendpoints()
                 state = True
-            else:
-                try:
-                    with open(feeds.keys()[0]) as fp:
-                        js = json.load(fp)
-                        eosc = EOSCReader(js, uidservtype, fetchtype)
-                        group_groups = eosc.get_groupgroups()
-                        group_endpoints = eosc.get_groupendpoints()
-                        state = True
-                except IOError as exc:
-                    logger.error('Customer:%s Job:%s : Problem opening %s - %s' % (logger.customer, logger.job, feeds.keys()[0], repr(exc)))
-                    state = False
+            except IOError as exc:
+                logger.error('Customer:%s Job:%s : Problem opening %s - %s' % (logger.customer, logger.job, feed, repr(exc)))
+                state = False
+            except input.ConnectorError:
+                state = False
 
             if fixed_date:
                 output.write_state(sys.argv[0], jobstatedir, state,
@@ -149,6 +174,10 @@ def main():
             numge = len(group_endpoints)
             numgg = len(group_groups)
 
+            if eval(globopts['GeneralPublishAms'.lower()]) and eval(globopts['GeneralWriteAvro'.lower()]):
+                group_groups = output.AvroData(globopts['AvroSchemasTopologyGroupOfGroups'.lower()], group_groups)
+                group_endpoints = output.AvroData(globopts['AvroSchemasTopologyGroupOfEndpoints'.lower()], group_endpoints)
+
             if eval(globopts['GeneralPublishAms'.lower()]):
                 if fixed_date:
                     partdate = fixed_date
@@ -164,7 +193,11 @@ def main():
                                         ams_opts['amspacksinglemsg'],
                                         logger,
                                         int(globopts['ConnectionRetry'.lower()]),
-                                        int(globopts['ConnectionTimeout'.lower()]))
+                                        int(globopts['ConnectionTimeout'.lower()]),
+                                        bulkbytes=ams_opts.get('AmsBulkBytes'.lower(), output.AMSBULKBYTES),
+                                        maxinflight=ams_opts.get('AmsMaxInFlight'.lower(), output.AMSMAXINFLIGHT),
+                                        statedir=jobstatedir,
+                                        savedays=globopts['InputStateDays'.lower()])
 
                 ams.send(globopts['AvroSchemasTopologyGroupOfGroups'.lower()],
                          'group_groups', partdate, group_groups)
@@ -26,6 +26,10 @@
 
 import argparse
 import copy
+import heapq
+import itertools
+import json
+import marshal
 import os
 import sys
 import re
@@ -36,6 +40,9 @@ from argo_egi_connectors.log import Logger
 
 from argo_egi_connectors.config import Global, CustomerConf
 from argo_egi_connectors.helpers import filename_date, module_class_name, datestamp, date_check
+from argo_egi_connectors.helpers import GroupOfEndpoints, GroupOfGroups
+from multiprocessing.pool import ThreadPool
+from urllib import quote
 from urlparse import urlparse
 
 logger = None
@@ -44,6 +51,21 @@ SERVENDPI = '/gocdbpi/private/?method=get_service_endpoint'
 SITESPI = '/gocdbpi/private/?method=get_site'
 SERVGROUPPI = '/gocdbpi/private/?method=get_service_group'
 
+# entities of multiple scopes are fetched at once if each of them
+# appeared in at least this many scopes on average
+SCOPEOVERLAP = 1.5
+
+ENDPOINTTAGS = ('scope', 'monitored', 'production')
+SITETAGS = ('certification', 'scope', 'infrastructure')
+SERVICEGROUPTAGS = ('monitored', 'scope')
+
+# selection tags of Sites jobs that GOCDB PI methods can filter by
+# itself: tag -> [(PI method, query parameter)]
+PUSHDOWN = {'GroupOfGroups': {'ngi': [(SITESPI, 'roc')],
+                              'site': [(SITESPI, 'sitename')],
+                              'certification': [(SITESPI, 'certification_status')]},
+            'GroupOfEndpoints': {'monitored': [(SERVENDPI, 'monitored')]}}
+
 fetchtype = ''
 
 globopts = {}
@@ -52,60 +74,350 @@ custname = ''
 isok = True
 
 
-def rem_nonalpha(string):
-    return re.sub(r'\W*', '', string)
+def page_cursor(buf):
+    """
+       Cheaply read count of entities and cursor of the next page from raw
+       data of paginated GOCDB PI response without parsing it.
+    """
+    count, cursor = None, None
+
+    match = re.search(r'<count>\s*(\d+)\s*</count>', buf)
+    if match:
+        count = int(match.group(1))
+
+    for link in re.findall(r'<link\s[^>]*>', buf):
+        if re.search(r'rel\s*=\s*["\']next["\']', link):
+            match = re.search(r'next_cursor=([^&"\'\s]+)', link)
+            if match:
+                cursor = match.group(1)
+
+    return count, cursor
+
+
+def getChildText(elem, tag):
+    return elem.find(tag).text or ''
+
+
+def getScopes(elem):
+    scopes = elem.find('SCOPES')
+    if scopes is None:
+        return []
+
+    return [scope.text for scope in scopes.iter('SCOPE') if scope.text]
+
+
+def service_endpoint_record(service):
+    return {'service_id': str(service.get('PRIMARY_KEY', '')),
+            'hostname': getChildText(service, 'HOSTNAME'),
+            'type': getChildText(service, 'SERVICE_TYPE'),
+            'monitored': getChildText(service, 'NODE_MONITORED'),
+            'production': getChildText(service, 'IN_PRODUCTION'),
+            'site': getChildText(service, 'SITENAME'),
+            'roc': getChildText(service, 'ROC_NAME'),
+            'scopes': getScopes(service)}
+
+
+def site_record(site):
+    return {'site': site.get('NAME', ''),
+            'infrastructure': getChildText(site, 'PRODUCTION_INFRASTRUCTURE'),
+            'certification': getChildText(site, 'CERTIFICATION_STATUS'),
+            'ngi': getChildText(site, 'ROC'),
+            'scopes': getScopes(site)}
+
+
+def service_group_record(group):
+    services = list()
+    for service in group.iter('SERVICE_ENDPOINT'):
+        if service.find('PRIMARY_KEY') is not None:
+            serviceId = getChildText(service, 'PRIMARY_KEY')
+        else:
+            serviceId = service.get('PRIMARY_KEY', '')
+        services.append({'hostname': getChildText(service, 'HOSTNAME'),
+                         'service_id': serviceId,
+                         'type': getChildText(service, 'SERVICE_TYPE'),
+                         'monitored': getChildText(service, 'NODE_MONITORED'),
+                         'production': getChildText(service, 'IN_PRODUCTION')})
+
+    return {'group_id': group.get('PRIMARY_KEY', ''),
+            'name': getChildText(group, 'NAME'),
+            'monitored': getChildText(group, 'MONITORED'),
+            'scopes': getScopes(group),
+            'services': services}
+
+
+def plan_pushdown(selections, spellings=None):
+    """
+       Plan query parameters of GOCDB PI methods out of the selections of
+       all jobs reading the same feed given as (fetchtype, ggtags, getags).
+       Only single value predicates that every job selects can be pushed
+       to GOCDB, everything else is left to TopoFilter that still applies
+       all of them. TopoFilter compares group of groups values regardless
+       of case while GOCDB does not, so these are pushed only in spelling
+       seen in topology fetched on the previous run.
+    """
+    spellings = dict((tag, dict((v.lower(), v) for v in values))
+                     for tag, values in (spellings or dict()).iteritems())
+    common = None
+    for fetchtype, ggtags, getags in selections:
+        if fetchtype != 'Sites':
+            return dict()
+
+        predicates = set()
+        for kind, tags in [('GroupOfGroups', ggtags), ('GroupOfEndpoints', getags)]:
+            for tag, value in tags.iteritems():
+                if isinstance(value, list):
+                    if len(value) != 1:
+                        continue
+                    value = value[0]
+                if tag.lower() == 'monitored':
+                    value = value.upper()
+                elif kind == 'GroupOfGroups':
+                    value = spellings.get(tag.lower(), dict()).get(value.lower())
+                    if value is None:
+                        continue
+                if tag.lower() in PUSHDOWN[kind]:
+                    predicates.add((kind, tag.lower(), value))
+
+        common = predicates if common is None else common & predicates
+
+    plan = dict()
+    for kind, tag, value in sorted(common or []):
+        if tag == 'monitored' and value not in ('Y', 'N'):
+            continue
+        for pi, param in PUSHDOWN[kind][tag]:
+            plan[pi] = plan.get(pi, '') + '&%s=%s' % (param, quote(value))
+
+    return plan
+
+
+def dedup_endpoints(ge):
+    """
+       Merge group of endpoints entities that differ only in their scope
+       into single one tagged with all of their scopes. Order of the first
+       appearance of entity is kept.
+    """
+    merged, order = dict(), list()
+    for e in ge:
+        tags = e['tags']
+        key = (e['type'], e['group'], e['service'], e['hostname'], e.get('group_monitored'),
+               tuple(sorted((k, v) for k, v in tags.iteritems() if k != 'scope')))
+        if key in merged:
+            merged[key][1].add(tags['scope'])
+        else:
+            merged[key] = (e, set([tags['scope']]))
+            order.append(key)
+
+    deduped = list()
+    for key in order:
+        e, scopes = merged[key]
+        if len(scopes) > 1:
+            e = e.with_tag('scope', ','.join(sorted(scopes)))
+        deduped.append(e)
+
+    return deduped
+
+
+class PageCheckpoint(object):
+    """
+       Records of every page of paginated PI method fetched so far, each
+       with the cursor of the page that follows, appended to the file in
+       InputStateSaveDir. Checkpoint is valid only on the day it was made.
+    """
+    def __init__(self, path, date):
+        self.path = path
+        self.date = date
+
+    def load(self):
+        """
+           Return (cursor, number of pages, records) of interrupted walk or
+           None if there is nothing to resume.
+        """
+        pages = list()
+        try:
+            with open(self.path, 'rb') as fp:
+                if marshal.load(fp) != self.date:
+                    return None
+                while True:
+                    try:
+                        pages.append(marshal.load(fp))
+                    except (EOFError, ValueError, TypeError):
+                        break
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+        if not pages:
+            return None
 
+        records = dict()
+        for _, page in pages:
+            records.update(page)
 
-def getText(nodelist):
-    rc = []
-    for node in nodelist:
-        if node.nodeType == node.TEXT_NODE:
-            rc.append(node.data)
-    return ''.join(rc)
+        return pages[-1][0], len(pages), records
+
+    def start(self):
+        try:
+            with open(self.path, 'wb') as fp:
+                marshal.dump(self.date, fp)
+        except IOError:
+            self.path = None
+
+    def append(self, cursor, records):
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'ab') as fp:
+                marshal.dump((cursor, records), fp)
+        except (IOError, ValueError):
+            self.path = None
+
+    def done(self):
+        if not self.path:
+            return
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class TopoStore(object):
+    """
+       Records of topology entities partitioned by scope. Each scope keeps
+       its own dict of records that is looked up directly by the scope name.
+       Entity that belongs to several scopes is stored once and referenced
+       from each of them.
+    """
+    def __init__(self, scopes):
+        self.scopes = list(scopes)
+        self._records = dict((scope, dict()) for scope in self.scopes)
+
+    def __getitem__(self, scope):
+        return self._records[scope]
+
+    def __setitem__(self, scope, records):
+        self._records[scope] = records
+
+    def items(self):
+        """
+           Iterate over (scope, record) pairs of all scopes without copying
+           records.
+        """
+        return itertools.chain.from_iterable(itertools.izip(itertools.repeat(scope),
+                                                            self._records[scope].itervalues())
+                                             for scope in self.scopes)
+
+    def sorted(self, key):
+        """
+           (scope, record) pairs of all scopes in a single order of records.
+           Records of each scope are sorted on their own and sorted runs are
+           merged.
+        """
+        runs = list()
+        for i, scope in enumerate(self.scopes):
+            run = sorted(self._records[scope].itervalues(), key=key)
+            runs.append([(key(r), i, j, r) for j, r in enumerate(run)])
+
+        return [(self.scopes[i], r) for _, i, _, r in heapq.merge(*runs)]
+
+    def count(self):
+        return sum(len(records) for records in self._records.itervalues())
+
+    def unique(self):
+        keys = set()
+        for records in self._records.itervalues():
+            keys.update(records.iterkeys())
+
+        return len(keys)
+
+    def partition(self, records):
+        """
+           Place records fetched for several scopes at once into scopes they
+           are tagged with.
+        """
+        scopes = dict((scope.lower(), scope) for scope in self.scopes)
+        for key, record in records.iteritems():
+            for scope in record['scopes']:
+                if scope.lower() in scopes:
+                    self._records[scopes[scope.lower()]][key] = record
+
+
+def scope_tag(scope):
+    return scope if scope != 'NoScope' else ''
 
 
 class GOCDBReader:
-    def __init__(self, feed, scopes, paging=False, auth=None):
+    def __init__(self, feed, scopes, paging=False, auth=None, pushdown=None):
         self._o = urlparse(feed)
+        self.pushdown = pushdown if pushdown else dict()
         self.scopes = scopes if scopes else set(['NoScope'])
-        for scope in self.scopes:
-            code = "self.serviceList%s = dict(); " % rem_nonalpha(scope)
-            code += "self.groupList%s = dict();" % rem_nonalpha(scope)
-            code += "self.siteList%s = dict()" % rem_nonalpha(scope)
-            exec code
+        self.serviceList = TopoStore(self.scopes)
+        self.groupList = TopoStore(self.scopes)
+        self.siteList = TopoStore(self.scopes)
         self.fetched = False
         self.state = True
         self.paging = paging
         self.custauth = auth
+        self._projections = dict()
+        self._indexes = dict()
+
+    def _projection(self, key, build):
+        """
+           Projection of topology is built once and shared by every job that
+           asks for the same one. Each job gets its own list, but entities in
+           it are shared and must not be modified.
+        """
+        if key not in self._projections:
+            self._projections[key] = build()
+
+        return list(self._projections[key])
+
+    def _projection_key(self, kind, uidservtype=False):
+        if kind == 'groups':
+            return (kind, fetchtype, custname if fetchtype == 'ServiceGroups' else None)
+        else:
+            return (kind, fetchtype, uidservtype)
+
+    def getIndex(self, kind, uidservtype=False):
+        """
+           TopoIndex over already built projection of given kind, that is
+           'services', 'endpoints' or 'groups'. Index is built once and
+           shared by every job filtering the same projection.
+        """
+        key = self._projection_key(kind, uidservtype)
+        if key not in self._projections:
+            return None
+        if key not in self._indexes:
+            self._indexes[key] = TopoIndex(self._projections[key])
+
+        return self._indexes[key]
 
     def getGroupOfServices(self, uidservtype=False):
         if not self.fetched:
             if not self.state or not self.loadDataIfNeeded():
                 return []
 
-        groups, gl = list(), list()
+        return self._projection(self._projection_key('services', uidservtype),
+                                lambda: self._group_of_services(uidservtype))
 
-        for scope in self.scopes:
-            code = "gl = gl + [value for key, value in self.groupList%s.iteritems()]" % rem_nonalpha(scope)
-            exec code
+    def _group_of_services(self, uidservtype):
+        groups = list()
 
-        for d in gl:
+        for scope, d in self.groupList.items():
             for service in d['services']:
-                g = dict()
-                g['type'] = fetchtype.upper()
-                g['group'] = d['name']
-                g['service'] = service['type']
                 if uidservtype:
-                    g['hostname'] = '{1}_{0}'.format(service['service_id'], service['hostname'])
+                    hostname = '{1}_{0}'.format(service['service_id'], service['hostname'])
                 else:
-                    g['hostname'] = service['hostname']
-                g['group_monitored'] = d['monitored']
-                g['tags'] = {'scope' : d['scope'], \
-                            'monitored' : '1' if service['monitored'].lower() == 'Y'.lower() or \
-                                                 service['monitored'].lower() == 'True'.lower() else '0', \
-                            'production' : '1' if service['production'].lower() == 'Y'.lower() or \
-                                                  service['production'].lower() == 'True'.lower() else '0'}
-                groups.append(g)
+                    hostname = service['hostname']
+                tags = (scope_tag(scope),
+                        '1' if service['monitored'].lower() == 'Y'.lower() or \
+                               service['monitored'].lower() == 'True'.lower() else '0',
+                        '1' if service['production'].lower() == 'Y'.lower() or \
+                               service['production'].lower() == 'True'.lower() else '0')
+                groups.append(GroupOfEndpoints(ENDPOINTTAGS, tags,
+                                               type=fetchtype.upper(),
+                                               group=d['name'],
+                                               service=service['type'],
+                                               hostname=hostname,
+                                               group_monitored=d['monitored']))
 
         return groups
 
@@ -114,37 +426,28 @@ class GOCDBReader:
             if not self.state or not self.loadDataIfNeeded():
                 return []
 
-        groupofgroups, gl = list(), list()
+        return self._projection(self._projection_key('groups'),
+                                self._group_of_groups)
+
+    def _group_of_groups(self):
+        groupofgroups = list()
 
         if fetchtype == "ServiceGroups":
-            for scope in self.scopes:
-                code = "gl = gl + [value for key, value in self.groupList%s.iteritems()]" % rem_nonalpha(scope)
-                exec code
-            for d in gl:
-                g = dict()
-                g['type'] = 'PROJECT'
-                g['group'] = custname
-                g['subgroup'] = d['name']
-                g['tags'] = {'monitored' : '1' if d['monitored'].lower() == 'Y'.lower() or \
-                                                  d['monitored'].lower() == 'True'.lower() else '0',
-                            'scope' : d['scope']}
-                groupofgroups.append(g)
+            for scope, d in self.groupList.items():
+                tags = ('1' if d['monitored'].lower() == 'Y'.lower() or \
+                               d['monitored'].lower() == 'True'.lower() else '0',
+                        scope_tag(scope))
+                groupofgroups.append(GroupOfGroups(SERVICEGROUPTAGS, tags,
+                                                   type='PROJECT',
+                                                   group=custname,
+                                                   subgroup=d['name']))
         else:
-            gg = []
-            for scope in self.scopes:
-                code = "gg = gg + sorted([value for key, value in self.siteList%s.iteritems()], key=lambda s: s['ngi'])" % rem_nonalpha(scope)
-                exec code
-
-            for gr in gg:
-                g = dict()
-                g['type'] = 'NGI'
-                g['group'] = gr['ngi']
-                g['subgroup'] = gr['site']
-                g['tags'] = {'certification' : gr['certification'], \
-                             'scope' : gr['scope'], \
-                             'infrastructure' : gr['infrastructure']}
-
-                groupofgroups.append(g)
+            for scope, gr in self.siteList.sorted(key=lambda s: s['ngi']):
+                tags = (gr['certification'], scope_tag(scope), gr['infrastructure'])
+                groupofgroups.append(GroupOfGroups(SITETAGS, tags,
+                                                   type='NGI',
+                                                   group=gr['ngi'],
+                                                   subgroup=gr['site']))
 
         return groupofgroups
 
@@ -153,71 +456,286 @@ class GOCDBReader:
             if not self.state or not self.loadDataIfNeeded():
                 return []
 
-        groupofendpoints, ge = list(), list()
-        for scope in self.scopes:
-            code = "ge = ge + sorted([value for key, value in self.serviceList%s.iteritems()], key=lambda s: s['site'])" % rem_nonalpha(scope)
-            exec code
+        return self._projection(self._projection_key('endpoints', uidservtype),
+                                lambda: self._group_of_endpoints(uidservtype))
+
+    def _group_of_endpoints(self, uidservtype):
+        groupofendpoints = list()
 
-        for gr in ge:
-            g = dict()
-            g['type'] = fetchtype.upper()
-            g['group'] = gr['site']
-            g['service'] = gr['type']
+        for scope, gr in self.serviceList.sorted(key=lambda s: s['site']):
             if uidservtype:
-                g['hostname'] = '{1}_{0}'.format(gr['service_id'], gr['hostname'])
+                hostname = '{1}_{0}'.format(gr['service_id'], gr['hostname'])
             else:
-                g['hostname'] = gr['hostname']
-            g['tags'] = {'scope': gr['scope'], \
-                         'monitored': '1' if gr['monitored'] == 'Y' or \
-                                             gr['monitored'] == 'True' else '0', \
-                         'production': '1' if gr['production'] == 'Y' or \
-                                              gr['production'] == 'True' else '0'}
-            groupofendpoints.append(g)
+                hostname = gr['hostname']
+            tags = (scope_tag(scope),
+                    '1' if gr['monitored'] == 'Y' or gr['monitored'] == 'True' else '0',
+                    '1' if gr['production'] == 'Y' or gr['production'] == 'True' else '0')
+            groupofendpoints.append(GroupOfEndpoints(ENDPOINTTAGS, tags,
+                                                     type=fetchtype.upper(),
+                                                     group=gr['site'],
+                                                     service=gr['type'],
+                                                     hostname=hostname))
 
         return groupofendpoints
 
-    def loadDataIfNeeded(self):
-        for scope in self.scopes:
-            scopequery = "'&scope='+scope" if scope != 'NoScope' else "'&scope='"
-            try:
-                eval("self.getServiceEndpoints(self.serviceList%s, %s)" % (rem_nonalpha(scope), scopequery))
-                eval("self.getServiceGroups(self.groupList%s, %s)" % (rem_nonalpha(scope), scopequery))
-                eval("self.getSitesInternal(self.siteList%s, %s)" % (rem_nonalpha(scope), scopequery))
-                self.fetched = True
-            except Exception:
-                self.state = False
-                return False
+    def _overlap_state(self):
+        if not globopts.get('InputStateSaveDir'.lower(), None):
+            return None
 
+        try:
+            return input.state_path(globopts, 'scopes', self._o.netloc + self._o.path + '?'
+                                    + ','.join(sorted(self.scopes)))
+        except OSError:
+            return None
+
+    def read_overlap(self):
+        """
+           Scope overlap measured on the previous run, that is how many times
+           on average each entity is repeated across fetched scopes.
+        """
+        statefile = self._overlap_state()
+        try:
+            with open(statefile) as fp:
+                return float(fp.read().strip())
+        except (TypeError, IOError, ValueError):
+            return None
+
+    def write_overlap(self):
+        """
+           Overlap is dropped if nothing was fetched to measure it on, so
+           the next run does not stay with the combined query only because
+           of an old measurement and asks for scopes one by one.
+        """
+        statefile = self._overlap_state()
+        stores = [self.serviceList, self.groupList, self.siteList]
+        unique = sum(store.unique() for store in stores)
+        stored = sum(store.count() for store in stores)
+        if not statefile:
+            return
+
+        try:
+            if unique:
+                with open(statefile, 'w') as fp:
+                    fp.write('%.2f' % (float(stored) / unique))
+            elif os.path.exists(statefile):
+                os.remove(statefile)
+        except (IOError, OSError):
+            pass
+
+    def _spellings_state(self):
+        if not globopts.get('InputStateSaveDir'.lower(), None):
+            return None
+
+        try:
+            return input.state_path(globopts, 'spellings', self._o.netloc + self._o.path)
+        except OSError:
+            return None
+
+    def read_spellings(self):
+        """
+           Spelling of NGI, Site and Certification values seen in topology
+           fetched on the previous run.
+        """
+        statefile = self._spellings_state()
+        try:
+            with open(statefile) as fp:
+                return dict((tag, [v.encode('utf-8') for v in values])
+                            for tag, values in json.load(fp).iteritems())
+        except (TypeError, IOError, ValueError, AttributeError):
+            return None
+
+    def write_spellings(self):
+        """
+           Spellings are kept only from sites fetched without pushed down
+           predicates. Pushed down fetch that found no sites might have used
+           spelling that is no longer valid, so it is dropped.
+        """
+        statefile = self._spellings_state()
+        if not statefile:
+            return
+
+        sites = [site for _, site in self.siteList.sorted(key=lambda s: s['site'])]
+        try:
+            if SITESPI not in self.pushdown and sites:
+                spellings = dict((tag, sorted(set(site[tag] for site in sites if tag in site)))
+                                 for tag in PUSHDOWN['GroupOfGroups'])
+                with open(statefile, 'w') as fp:
+                    json.dump(spellings, fp)
+            elif not sites and os.path.exists(statefile):
+                os.remove(statefile)
+        except (IOError, OSError):
+            pass
+
+    def fetch_combined(self):
+        """
+           Entities of several scopes are fetched with single query and
+           placed into scopes locally if they overlapped enough on the
+           previous run.
+        """
+        if len(self.scopes) < 2 or 'NoScope' in self.scopes:
+            return False
+
+        overlap = self.read_overlap()
+        return overlap is not None and overlap >= SCOPEOVERLAP
+
+    def loadDataIfNeeded(self):
+        fetches, combined = list(), list()
+        if self.fetch_combined():
+            scopequery = '&scope=' + ','.join(sorted(self.scopes)) + '&scope_match=any'
+            for method, pi, store in [(self.getServiceEndpoints, SERVENDPI, self.serviceList),
+                                      (self.getServiceGroups, SERVGROUPPI, self.groupList),
+                                      (self.getSitesInternal, SITESPI, self.siteList)]:
+                records = dict()
+                combined.append((store, records))
+                fetches.append((method, records, scopequery + self.pushdown.get(pi, '')))
+        else:
+            for scope in self.scopes:
+                scopequery = '&scope=' + scope if scope != 'NoScope' else '&scope='
+                fetches.append((self.getServiceEndpoints, self.serviceList[scope],
+                                scopequery + self.pushdown.get(SERVENDPI, '')))
+                fetches.append((self.getServiceGroups, self.groupList[scope],
+                                scopequery + self.pushdown.get(SERVGROUPPI, '')))
+                fetches.append((self.getSitesInternal, self.siteList[scope],
+                                scopequery + self.pushdown.get(SITESPI, '')))
+
+        # every (scope, method) pair fills its own dict so they can be
+        # fetched at once; input.connection() caps requests per host
+        maxperhost = int(globopts.get('ConnectionMaxPerHost'.lower(), input.MAXPERHOST))
+        pool = ThreadPool(min(len(fetches), maxperhost))
+        try:
+            pending = [pool.apply_async(method, (datalist, scopequery))
+                       for method, datalist, scopequery in fetches]
+            for p in pending:
+                try:
+                    p.get()
+                except Exception:
+                    self.state = False
+        finally:
+            pool.close()
+            pool.join()
+
+        if not self.state:
+            return False
+
+        for store, records in combined:
+            store.partition(records)
+
+        self.write_overlap()
+        self.write_spellings()
+        self.fetched = True
         return True
 
-    def _get_xmldata(self, scope, pi):
+    def _get_rawdata(self, scope, pi, stream=False):
         res = input.connection(logger, module_class_name(self), globopts,
-                               self._o.scheme, self._o.netloc, pi + scope, custauth=self.custauth)
+                               self._o.scheme, self._o.netloc, pi + scope, custauth=self.custauth,
+                               stream=stream)
         if not res:
             raise input.ConnectorError()
 
-        doc = input.parse_xml(logger, module_class_name(self), globopts, res,
-                              self._o.scheme + '://' + self._o.netloc + pi)
-        return doc
+        return res
+
+    def _fetch_streamed(self, datalist, scope, pi, extract):
+        """
+           Fetch PI method that is not paginated and extract its records
+           while it is downloading. Fetch is retried if the transfer breaks.
+        """
+        def fetch():
+            fetched = dict()
+            res = self._get_rawdata(scope, pi, stream=True)
+            extract(fetched, scope, res)
+            return fetched
+
+        datalist.update(input.fetch_streamed(logger, module_class_name(self), globopts, fetch))
+
+    def _get_pages(self, scope, pi, cursor='0'):
+        """
+           Generator that yields cursor of the next page, or None for the
+           last one, and raw page of paginated PI method. Cursor of the next
+           page is read out of raw data and the next page is requested right
+           away so its fetching overlaps with the parsing and extracting of
+           the current page.
+        """
+        prefetch = ThreadPool(1)
+        try:
+            pending = prefetch.apply_async(self._get_rawdata, (scope, pi + '&next_cursor=' + cursor))
+            while pending:
+                res = pending.get()
+                count, cursor = page_cursor(res)
+                if count is None:
+                    logger.error(module_class_name(self) + ' Customer:%s Job:%s : Error parsing feed %s - no count of entities in page' % (logger.customer, logger.job,
+                                                                                                                                           self._o.scheme + '://' + self._o.netloc + pi))
+                    raise input.ConnectorError()
+                if count != 0 and cursor is not None:
+                    pending = prefetch.apply_async(self._get_rawdata, (scope, pi + '&next_cursor=' + cursor))
+                else:
+                    pending, cursor = None, None
+
+                yield cursor, res
+        finally:
+            prefetch.close()
+            prefetch.join()
+
+    def _checkpoint(self, scope, pi):
+        if not globopts.get('InputStateSaveDir'.lower(), None):
+            return None
 
-    def _get_service_endpoints(self, serviceList, scope, doc):
         try:
-            services = doc.getElementsByTagName('SERVICE_ENDPOINT')
+            return PageCheckpoint(input.state_path(globopts, 'paging', self._o.netloc + pi + scope),
+                                  datestamp())
+        except OSError:
+            return None
+
+    def _walk_pages(self, datalist, scope, pi, extract):
+        """
+           Walk paginated PI method and extract records of every page with
+           extract(). Walk is checkpointed after each page so if it fails,
+           next run on the same day resumes from the last good cursor.
+        """
+        checkpoint = self._checkpoint(scope, pi)
+        resumed = checkpoint.load() if checkpoint else None
+        if resumed:
+            cursor, page, records = resumed
+            datalist.update(records)
+            logger.info(module_class_name(self) + ' Customer:%s Job:%s : Resuming feed %s from page %d' % (logger.customer, logger.job,
+                                                                                                          self._o.scheme + '://' + self._o.netloc + pi, page))
+        else:
+            cursor, page = '0', 0
+            if checkpoint:
+                checkpoint.start()
+
+        if cursor is not None:
+            for cursor, res in self._get_pages(scope, pi, cursor):
+                pagelist = dict()
+                extract(pagelist, scope, res, page)
+                datalist.update(pagelist)
+                if checkpoint:
+                    checkpoint.append(cursor, pagelist)
+                page += 1
+
+        if checkpoint:
+            checkpoint.done()
+
+    def _parse_records(self, res, pi, scope, page, tag, extract):
+        """
+           Extract records of entities from raw data. Records of each page of
+           paginated PI method are cached between runs so unchanged pages are
+           not parsed again.
+        """
+        feed = self._o.scheme + '://' + self._o.netloc + pi
+        parse = lambda buf: input.parse_xml_records(logger, module_class_name(self), globopts,
+                                                    buf, feed, tag, extract)
+        if page is None:
+            return parse(res)
+
+        return input.cached_records(globopts, feed + scope + '#%d' % page, res, parse)
+
+    def _get_service_endpoints(self, serviceList, scope, res, page=None):
+        try:
+            services = self._parse_records(res, SERVENDPI, scope, page, 'SERVICE_ENDPOINT',
+                                           service_endpoint_record)
             for service in services:
-                serviceId = ''
-                if service.getAttributeNode('PRIMARY_KEY'):
-                    serviceId = str(service.attributes['PRIMARY_KEY'].value)
-                if serviceId not in serviceList:
-                    serviceList[serviceId] = {}
-                serviceList[serviceId]['hostname'] = getText(service.getElementsByTagName('HOSTNAME')[0].childNodes)
-                serviceList[serviceId]['type'] = getText(service.getElementsByTagName('SERVICE_TYPE')[0].childNodes)
-                serviceList[serviceId]['monitored'] = getText(service.getElementsByTagName('NODE_MONITORED')[0].childNodes)
-                serviceList[serviceId]['production'] = getText(service.getElementsByTagName('IN_PRODUCTION')[0].childNodes)
-                serviceList[serviceId]['site'] = getText(service.getElementsByTagName('SITENAME')[0].childNodes)
-                serviceList[serviceId]['roc'] = getText(service.getElementsByTagName('ROC_NAME')[0].childNodes)
-                serviceList[serviceId]['service_id'] = serviceId
-                serviceList[serviceId]['scope'] = scope.split('=')[1]
-                serviceList[serviceId]['sortId'] = serviceList[serviceId]['hostname'] + '-' + serviceList[serviceId]['type'] + '-' + serviceList[serviceId]['site']
+                service['sortId'] = service['hostname'] + '-' + service['type'] + '-' + service['site']
+                serviceList[service['service_id']] = service
 
         except (KeyError, IndexError, TypeError, AttributeError, AssertionError) as e:
             logger.error(module_class_name(self) + 'Customer:%s Job:%s : Error parsing feed %s - %s' % (logger.customer, logger.job, self._o.scheme + '://' + self._o.netloc + SERVENDPI,
@@ -227,22 +745,10 @@ class GOCDBReader:
     def getServiceEndpoints(self, serviceList, scope):
         try:
             if self.paging:
-                count, cursor = 1, 0
-                while count != 0:
-                    doc = self._get_xmldata(scope, SERVENDPI + '&next_cursor=' + str(cursor))
-                    count = int(doc.getElementsByTagName('count')[0].childNodes[0].data)
-                    links = doc.getElementsByTagName('link')
-                    for le in links:
-                        if le.getAttribute('rel') == 'next':
-                            href = le.getAttribute('href')
-                            for e in href.split('&'):
-                                if 'next_cursor' in e:
-                                    cursor = e.split('=')[1]
-                    self._get_service_endpoints(serviceList, scope, doc)
+                self._walk_pages(serviceList, scope, SERVENDPI, self._get_service_endpoints)
 
             else:
-                doc = self._get_xmldata(scope, SERVENDPI)
-                self._get_service_endpoints(serviceList, scope, doc)
+                self._fetch_streamed(serviceList, scope, SERVENDPI, self._get_service_endpoints)
 
         except input.ConnectorError as e:
             raise e
@@ -250,17 +756,11 @@ class GOCDBReader:
         except Exception as e:
             raise e
 
-    def _get_sites_internal(self, siteList, scope, doc):
+    def _get_sites_internal(self, siteList, scope, res, page=None):
         try:
-            sites = doc.getElementsByTagName('SITE')
+            sites = self._parse_records(res, SITESPI, scope, page, 'SITE', site_record)
             for site in sites:
-                siteName = site.getAttribute('NAME')
-                if siteName not in siteList:
-                    siteList[siteName] = {'site': siteName}
-                siteList[siteName]['infrastructure'] = getText(site.getElementsByTagName('PRODUCTION_INFRASTRUCTURE')[0].childNodes)
-                siteList[siteName]['certification'] = getText(site.getElementsByTagName('CERTIFICATION_STATUS')[0].childNodes)
-                siteList[siteName]['ngi'] = getText(site.getElementsByTagName('ROC')[0].childNodes)
-                siteList[siteName]['scope'] = scope.split('=')[1]
+                siteList[site['site']] = site
 
         except (KeyError, IndexError, TypeError, AttributeError, AssertionError) as e:
             logger.error(module_class_name(self) + 'Customer:%s Job:%s : Error parsing feed %s - %s' % (logger.customer, logger.job, self._o.scheme + '://' + self._o.netloc + SITESPI,
@@ -270,22 +770,10 @@ class GOCDBReader:
     def getSitesInternal(self, siteList, scope):
         try:
             if self.paging:
-                count, cursor = 1, 0
-                while count != 0:
-                    doc = self._get_xmldata(scope, SITESPI + '&next_cursor=' + str(cursor))
-                    count = int(doc.getElementsByTagName('count')[0].childNodes[0].data)
-                    links = doc.getElementsByTagName('link')
-                    for le in links:
-                        if le.getAttribute('rel') == 'next':
-                            href = le.getAttribute('href')
-                            for e in href.split('&'):
-                                if 'next_cursor' in e:
-                                    cursor = e.split('=')[1]
-                    self._get_sites_internal(siteList, scope, doc)
+                self._walk_pages(siteList, scope, SITESPI, self._get_sites_internal)
 
             else:
-                doc = self._get_xmldata(scope, SITESPI)
-                self._get_sites_internal(siteList, scope, doc)
+                self._fetch_streamed(siteList, scope, SITESPI, self._get_sites_internal)
 
         except input.ConnectorError as e:
             raise e
@@ -293,30 +781,12 @@ class GOCDBReader:
         except Exception as e:
             raise e
 
-    def _get_service_groups(self, groupList, scope, doc):
+    def _get_service_groups(self, groupList, scope, res, page=None):
         try:
-            doc = self._get_xmldata(scope, SERVGROUPPI)
-            groups = doc.getElementsByTagName('SERVICE_GROUP')
+            groups = self._parse_records(res, SERVGROUPPI, scope, page, 'SERVICE_GROUP',
+                                         service_group_record)
             for group in groups:
-                groupId = group.getAttribute('PRIMARY_KEY')
-                if groupId not in groupList:
-                    groupList[groupId] = {}
-                groupList[groupId]['name'] = getText(group.getElementsByTagName('NAME')[0].childNodes)
-                groupList[groupId]['monitored'] = getText(group.getElementsByTagName('MONITORED')[0].childNodes)
-                groupList[groupId]['scope'] = scope.split('=')[1]
-                groupList[groupId]['services'] = []
-                services = group.getElementsByTagName('SERVICE_ENDPOINT')
-                for service in services:
-                    serviceDict = {}
-                    serviceDict['hostname'] = getText(service.getElementsByTagName('HOSTNAME')[0].childNodes)
-                    try:
-                        serviceDict['service_id'] = getText(service.getElementsByTagName('PRIMARY_KEY')[0].childNodes)
-                    except IndexError:
-                        serviceDict['service_id'] = service.getAttribute('PRIMARY_KEY')
-                    serviceDict['type'] = getText(service.getElementsByTagName('SERVICE_TYPE')[0].childNodes)
-                    serviceDict['monitored'] = getText(service.getElementsByTagName('NODE_MONITORED')[0].childNodes)
-                    serviceDict['production'] = getText(service.getElementsByTagName('IN_PRODUCTION')[0].childNodes)
-                    groupList[groupId]['services'].append(serviceDict)
+                groupList[group.pop('group_id')] = group
 
         except (KeyError, IndexError, TypeError, AttributeError, AssertionError) as e:
             logger.error(module_class_name(self) + 'Customer:%s Job:%s : Error parsing feed %s - %s' % (logger.customer, logger.job, self._o.scheme + '://' + self._o.netloc + SERVGROUPPI,
@@ -326,22 +796,10 @@ class GOCDBReader:
     def getServiceGroups(self, groupList, scope):
         try:
             if self.paging:
-                count, cursor = 1, 0
-                while count != 0:
-                    doc = self._get_xmldata(scope, SERVGROUPPI + '&next_cursor=' + str(cursor))
-                    count = int(doc.getElementsByTagName('count')[0].childNodes[0].data)
-                    links = doc.getElementsByTagName('link')
-                    for le in links:
-                        if le.getAttribute('rel') == 'next':
-                            href = le.getAttribute('href')
-                            for e in href.split('&'):
-                                if 'next_cursor' in e:
-                                    cursor = e.split('=')[1]
-                    self._get_service_groups(groupList, scope, doc)
+                self._walk_pages(groupList, scope, SERVGROUPPI, self._get_service_groups)
 
             else:
-                doc = self._get_xmldata(scope, SERVGROUPPI)
-                self._get_service_groups(groupList, scope, doc)
+                self._fetch_streamed(groupList, scope, SERVGROUPPI, self._get_service_groups)
 
         except input.ConnectorError as e:
             raise e
@@ -350,10 +808,56 @@ class GOCDBReader:
             raise e
 
 
+class TopoIndex(object):
+    """
+       Inverted index over group of groups or group of endpoints. For every
+       tag value and every group and subgroup name it keeps the set of
+       positions of entities that carry it, so selections of jobs are
+       answered with set intersections instead of scanning entities.
+    """
+    def __init__(self, entities):
+        self.entities = entities
+        self._tags = dict()
+        self._tagged = dict()
+        self._fields = dict()
+        for i, e in enumerate(entities):
+            for tag, value in e['tags'].iteritems():
+                self._tags.setdefault(tag, dict()).setdefault(value.lower(), set()).add(i)
+                self._tagged[tag] = self._tagged.get(tag, 0) + 1
+            for field in ('group', 'subgroup'):
+                if field in e:
+                    self._fields.setdefault(field, dict()).setdefault(e[field], set()).add(i)
+
+    def has_tag(self, tag):
+        return self._tagged.get(tag, 0) == len(self.entities)
+
+    def tag(self, tag, accepted):
+        postings = self._tags.get(tag, {})
+        return set().union(*[postings[v] for v in accepted if v in postings])
+
+    def field(self, field, values, lower=False):
+        postings = self._fields.get(field, {})
+        if lower:
+            keys = [k for k in postings.iterkeys() if k.lower() in values]
+        else:
+            keys = [k for k in values if k in postings]
+
+        return set().union(*[postings[k] for k in keys])
+
+    def select(self, postings):
+        if not postings:
+            return list(self.entities)
+
+        postings = sorted(postings, key=len)
+        return [self.entities[i] for i in sorted(postings[0].intersection(*postings[1:]))]
+
+
 class TopoFilter(object):
-    def __init__(self, gg, ge, ggfilter, gefilter):
+    def __init__(self, gg, ge, ggfilter, gefilter, ggindex=None, geindex=None):
         self.gg = gg
         self.ge = ge
+        self.ggindex = ggindex
+        self.geindex = geindex
         self.ggfilter = copy.copy(ggfilter)
         self.gefilter = copy.copy(gefilter)
         self.subgroupfilter = self.extract_filter('site', self.ggfilter) or \
@@ -362,21 +866,38 @@ class TopoFilter(object):
         self.topofilter()
 
     def topofilter(self):
-        if self.subgroupfilter:
-            self.gg = filter(lambda e: e['subgroup'].lower() in self.subgroupfilter, self.gg)
+        subgroups = self.compile_values(self.subgroupfilter)
+        groups = self.compile_values(self.groupfilter)
 
-        if self.groupfilter:
-            self.gg = filter(lambda e: e['group'].lower() in self.groupfilter, self.gg)
+        if self.ggindex:
+            postings = list()
+            if subgroups is not None:
+                postings.append(self.ggindex.field('subgroup', subgroups, lower=True))
+            if groups is not None:
+                postings.append(self.ggindex.field('group', groups, lower=True))
+            self.gg = self.filter_index(self.ggfilter, self.ggindex, postings)
 
-        if self.ggfilter:
-            self.gg = self.filter_tags(self.ggfilter, self.gg)
+        else:
+            def ggmatch(e):
+                return (subgroups is None or e['subgroup'].lower() in subgroups) and \
+                    (groups is None or e['group'].lower() in groups)
+
+            self.gg = self.filter_tags(self.ggfilter, self.gg, ggmatch)
 
         allsubgroups = set([e['subgroup'] for e in self.gg])
-        if allsubgroups:
-            self.ge = filter(lambda e: e['group'] in allsubgroups, self.ge)
+        if self.geindex:
+            postings = list()
+            if allsubgroups:
+                postings.append(self.geindex.field('group', allsubgroups))
+            self.ge = self.filter_index(self.gefilter, self.geindex, postings)
+
+        else:
+            if allsubgroups:
+                gematch = lambda e: e['group'] in allsubgroups
+            else:
+                gematch = None
 
-        if self.gefilter:
-            self.ge = self.filter_tags(self.gefilter, self.ge)
+            self.ge = self.filter_tags(self.gefilter, self.ge, gematch)
 
     def extract_filter(self, tag, ggtags):
         gg = None
@@ -393,26 +914,66 @@ class TopoFilter(object):
 
         return gg
 
-    def filter_tags(self, tags, listofelem):
-        for attr in tags.keys():
-            def getit(elem):
-                value = elem['tags'][attr.lower()]
-                if value == '1':
-                    value = 'Y'
-                elif value == '0':
-                    value = 'N'
-                if isinstance(tags[attr], list):
-                    for a in tags[attr]:
-                        if value.lower() == a.lower():
-                            return True
-                else:
-                    if value.lower() == tags[attr].lower():
-                        return True
+    @staticmethod
+    def compile_values(values):
+        if values is None:
+            return None
+        if not isinstance(values, list):
+            values = [values]
+
+        return frozenset(v.lower() for v in values)
+
+    def compile_tags(self, tags):
+        """
+           Compile tags selection into (tag, accepted values) pairs. Values
+           are lowercased and Y/N selection also accepts 1/0 flags so each
+           value of element is only lowercased and looked up.
+        """
+        compiled = list()
+        for attr, values in tags.iteritems():
+            values = self.compile_values(values)
+            accepted = set(v for v in values if v not in ('1', '0'))
+            if 'y' in values:
+                accepted.add('1')
+            if 'n' in values:
+                accepted.add('0')
+            compiled.append((attr.lower(), frozenset(accepted)))
+
+        return compiled
+
+    def filter_tags(self, tags, listofelem, match=None):
+        """
+           Single pass over elements that keeps those accepted by match and
+           by every tag. Tag that elements do not have is reported and
+           filtering is repeated without it.
+        """
+        compiled = self.compile_tags(tags)
+        if not compiled and not match:
+            return listofelem
+
+        while True:
             try:
-                listofelem = filter(getit, listofelem)
+                return [e for e in listofelem
+                        if (not match or match(e)) and
+                        all(e['tags'][attr].lower() in accepted for attr, accepted in compiled)]
             except KeyError as e:
+                if e.args[0] not in [attr for attr, _ in compiled]:
+                    raise e
                 logger.error('Customer:%s Job:%s : Wrong tags specified: %s' % (logger.customer, logger.job, e))
-        return listofelem
+                compiled = [(attr, accepted) for attr, accepted in compiled if attr != e.args[0]]
+
+    def filter_index(self, tags, index, postings):
+        """
+           Same selection as filter_tags() answered by intersecting postings
+           of TopoIndex.
+        """
+        for attr, accepted in self.compile_tags(tags):
+            if not index.has_tag(attr):
+                logger.error('Customer:%s Job:%s : Wrong tags specified: %s' % (logger.customer, logger.job, KeyError(attr)))
+                continue
+            postings.append(index.tag(attr, accepted))
+
+        return index.select(postings)
 
 
 def main():
@@ -450,6 +1011,9 @@ def main():
         auth_complete, missing = cglob.is_complete(auth_opts, 'authentication')
         if auth_complete:
             gocdb = GOCDBReader(feed, scopes, paging, auth=auth_opts)
+            gocdb.pushdown = plan_pushdown([(confcust.get_fetchtype(job), confcust.get_gocdb_ggtags(job),
+                                             confcust.get_gocdb_getags(job)) for job, cust in jobcust],
+                                           gocdb.read_spellings())
         else:
             logger.error('%s options incomplete, missing %s' % ('authentication', ' '.join(missing)))
             continue
@@ -495,9 +1059,21 @@ def main():
 
             ggtags = confcust.get_gocdb_ggtags(job)
             getags = confcust.get_gocdb_getags(job)
-            tf = TopoFilter(group_groups, group_endpoints, ggtags, getags)
+            ggindex, geindex = None, None
+            if len(jobcust) > 1:
+                # jobs on the same feed differ only in their selections
+                ggindex = gocdb.getIndex('groups')
+                geindex = gocdb.getIndex('services' if fetchtype == 'ServiceGroups' else 'endpoints',
+                                         uidservtype)
+            tf = TopoFilter(group_groups, group_endpoints, ggtags, getags, ggindex, geindex)
             group_groups = tf.gg
             group_endpoints = tf.ge
+            if confcust.dedup_endpoints(job):
+                group_endpoints = dedup_endpoints(group_endpoints)
+
+            if eval(globopts['GeneralPublishAms'.lower()]) and eval(globopts['GeneralWriteAvro'.lower()]):
+                group_groups = output.AvroData(globopts['AvroSchemasTopologyGroupOfGroups'.lower()], group_groups)
+                group_endpoints = output.AvroData(globopts['AvroSchemasTopologyGroupOfEndpoints'.lower()], group_endpoints)
 
             if eval(globopts['GeneralPublishAms'.lower()]):
                 if fixed_date:
@@ -514,7 +1090,11 @@ def main():
                                         ams_opts['amspacksinglemsg'],
                                         logger,
                                         int(globopts['ConnectionRetry'.lower()]),
-                                        int(globopts['ConnectionTimeout'.lower()]))
+                                        int(globopts['ConnectionTimeout'.lower()]),
+                                        bulkbytes=ams_opts.get('AmsBulkBytes'.lower(), output.AMSBULKBYTES),
+                                        maxinflight=ams_opts.get('AmsMaxInFlight'.lower(), output.AMSMAXINFLIGHT),
+                                        statedir=jobstatedir,
+                                        savedays=globopts['InputStateDays'.lower()])
 
                 ams.send(globopts['AvroSchemasTopologyGroupOfGroups'.lower()],
                          'group_groups', partdate, group_groups)
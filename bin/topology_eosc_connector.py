@@ -0,0 +1 @@
+topology-eosc-connector.py
\ No newline at end of file
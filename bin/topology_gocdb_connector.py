@@ -0,0 +1 @@
+topology-gocdb-connector.py
\ No newline at end of file
@@ -41,6 +41,14 @@ logger = None
 
 VAPORPI = 'https://operations-portal.egi.eu/vapor/downloadLavoisier/option/json/view/VAPOR_Ngi_Sites_Info'
 
+def ngi_sites(ngi):
+    sites = list()
+    for site in ngi['site']:
+        sites.append(dict((k, site[k]) for k in ('id', 'ComputationPower') if k in site))
+
+    return {'ngi': ngi['ngi'], 'site': sites}
+
+
 class Vapor:
     def __init__(self, feed):
         self._o = urlparse(feed)
@@ -48,39 +56,47 @@ class Vapor:
 
     def getWeights(self):
         try:
-            res = input.connection(logger, module_class_name(self), globopts,
-                                   self._o.scheme, self._o.netloc,
-                                   self._o.path)
-            if not res:
-                raise input.ConnectorError()
-
-            json_data = input.parse_json(logger, module_class_name(self), globopts, res,
-                                         self._o.scheme + '://' + self._o.netloc + self._o.path)
-
-            if not json_data:
-                raise input.ConnectorError()
+            # jobs reading the same feed share weights fetched by the first one
+            return input.single_flight(input.request_key(globopts, self._o.scheme, self._o.netloc, self._o.path),
+                                       lambda: input.fetch_streamed(logger, module_class_name(self), globopts,
+                                                                    self._fetch_weights))
 
         except input.ConnectorError:
             self.state = False
             return []
 
-        else:
-            try:
-                weights = dict()
-                for ngi in json_data:
-                    for site in ngi['site']:
-                        key = site['id']
-                        if 'ComputationPower' in site:
-                            val = site['ComputationPower']
-                        else:
-                            logger.warn(module_class_name(self) + ': No ComputationPower value for NGI:%s Site:%s' % (ngi['ngi'] ,site['id']))
-                            val = '0'
-                        weights[key] = val
-                return weights
-            except (KeyError, IndexError) as e:
-                self.state = False
-                logger.error(module_class_name(self) + ': Error parsing feed %s - %s' % (self._o.scheme + '://' + self._o.netloc + self._o.path,
-                                                                                         repr(e).replace('\'','')))
+    def _fetch_weights(self):
+        res = input.connection(logger, module_class_name(self), globopts,
+                               self._o.scheme, self._o.netloc,
+                               self._o.path, stream=True)
+        if not res:
+            raise input.ConnectorError()
+
+        ngis = input.parse_json_records(logger, module_class_name(self), globopts, res,
+                                        self._o.scheme + '://' + self._o.netloc + self._o.path,
+                                        ngi_sites)
+
+        try:
+            weights, empty = dict(), True
+            for ngi in ngis:
+                empty = False
+                for site in ngi['site']:
+                    key = site['id']
+                    if 'ComputationPower' in site:
+                        val = site['ComputationPower']
+                    else:
+                        logger.warn(module_class_name(self) + ': No ComputationPower value for NGI:%s Site:%s' % (ngi['ngi'] ,site['id']))
+                        val = '0'
+                    weights[key] = val
+
+            if empty:
+                raise input.ConnectorError()
+
+            return weights
+        except (KeyError, IndexError, TypeError) as e:
+            logger.error(module_class_name(self) + ': Error parsing feed %s - %s' % (self._o.scheme + '://' + self._o.netloc + self._o.path,
+                                                                                     repr(e).replace('\'','')))
+            raise input.ConnectorError()
 
 
 def data_out(data):
@@ -164,6 +180,9 @@ def main():
                 continue
 
             datawr = data_out(w)
+            if eval(globopts['GeneralPublishAms'.lower()]) and eval(globopts['GeneralWriteAvro'.lower()]):
+                datawr = output.AvroData(globopts['AvroSchemasWeights'.lower()], datawr)
+
             if eval(globopts['GeneralPublishAms'.lower()]):
                 if fixed_date:
                     partdate = fixed_date
@@ -179,7 +198,11 @@ def main():
                                         ams_opts['amspacksinglemsg'],
                                         logger,
                                         int(globopts['ConnectionRetry'.lower()]),
-                                        int(globopts['ConnectionTimeout'.lower()]))
+                                        int(globopts['ConnectionTimeout'.lower()]),
+                                        bulkbytes=ams_opts.get('AmsBulkBytes'.lower(), output.AMSBULKBYTES),
+                                        maxinflight=ams_opts.get('AmsMaxInFlight'.lower(), output.AMSMAXINFLIGHT),
+                                        statedir=jobstatedir,
+                                        savedays=globopts['InputStateDays'.lower()])
 
                 ams.send(globopts['AvroSchemasWeights'.lower()], 'weights',
                          partdate, datawr)
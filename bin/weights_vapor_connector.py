@@ -0,0 +1 @@
+weights-vapor-connector.py
\ No newline at end of file
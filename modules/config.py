@@ -11,14 +11,22 @@ class Global(object):
        Class represents parser for global.conf
     """
     # options common for all connectors
-    conf_ams = {'AMS': ['Host', 'Token', 'Project', 'Topic', 'Bulk', 'PackSingleMsg']}
+    conf_ams = {'AMS': ['Host', 'Token', 'Project', 'Topic', 'Bulk', 'PackSingleMsg',
+                        'BulkBytes', 'MaxInFlight']}
     conf_general = {'General': ['PublishAms', 'WriteAvro']}
     conf_auth = {'Authentication': ['HostKey', 'HostCert', 'CAPath', 'CAFile',
                                     'VerifyServerCert', 'UsePlainHttpAuth',
                                     'HttpUser', 'HttpPass']}
-    conf_conn = {'Connection': ['Timeout', 'Retry', 'SleepRetry']}
-    conf_state = {'InputState': ['SaveDir', 'Days']}
+    conf_conn = {'Connection': ['Timeout', 'Retry', 'SleepRetry', 'PoolSize',
+                                'MaxPerHost']}
+    conf_state = {'InputState': ['SaveDir', 'Days', 'CacheResponses', 'CacheRecords']}
     conf_webapi = {'WebAPI': ['Token', 'Host']}
+    conf_parser = {'Parser': ['Backend']}
+
+    # options that can be left out of otherwise mandatory sections
+    conf_tunables = {'AMS': ['BulkBytes', 'MaxInFlight'],
+                     'Connection': ['PoolSize', 'MaxPerHost'],
+                     'InputState': ['CacheResponses', 'CacheRecords']}
 
     # options specific for every connector
     conf_topo_schemas = {'AvroSchemas': ['TopologyGroupOfEndpoints',
@@ -42,12 +50,15 @@ class Global(object):
         self.optional.update(self._lowercase_dict(self.conf_ams))
         self.optional.update(self._lowercase_dict(self.conf_auth))
         self.optional.update(self._lowercase_dict(self.conf_webapi))
+        self.optional.update(self._lowercase_dict(self.conf_parser))
+        self.tunables = set(self._concat_sectopt(self._lowercase_dict(self.conf_tunables)))
 
         self.shared_secopts = self._merge_dict(self.conf_ams,
                                                self.conf_general,
                                                self.conf_auth, self.conf_conn,
                                                self.conf_state,
-                                               self.conf_webapi)
+                                               self.conf_webapi,
+                                               self.conf_parser)
         self.secopts = {'topology-gocdb-connector.py':
                         self._merge_dict(self.shared_secopts,
                                          self.conf_topo_schemas,
@@ -99,8 +110,8 @@ class Global(object):
         return newd
 
     def is_complete(self, opts, section):
-        all = set([section + o for o in self.optional[section]])
-        diff = all.symmetric_difference(opts.keys())
+        all = set([section + o for o in self.optional[section]]) - self.tunables
+        diff = all.symmetric_difference(set(opts.keys()) - self.tunables)
         if diff:
             return (False, diff)
         return (True, None)
@@ -159,8 +170,9 @@ class Global(object):
 
                             except ConfigParser.NoOptionError as e:
                                 s = e.section.lower()
-                                if (s in self.optional.keys() and
-                                    e.option in self.optional[s]):
+                                if ((s in self.optional.keys() and
+                                     e.option in self.optional[s]) or
+                                    s + e.option in self.tunables):
                                     pass
                                 else:
                                     raise e
@@ -195,7 +207,8 @@ class CustomerConf(object):
                                                     'TopoSelectGroupOfEndpoints',
                                                     'TopoUIDServiceEndpoints',
                                                     'TopoFeed',
-                                                    'TopoFeedPaging'],
+                                                    'TopoFeedPaging',
+                                                    'TopoDedupEndpoints'],
                     'topology-eosc-connector.py': ['TopoFeed', 'TopoFile', 'TopoFetchType',
                                                    'TopoUIDServiceEndpoints'],
                     'metricprofile-webapi-connector.py': ['MetricProfileNamespace'],
@@ -485,6 +498,15 @@ class CustomerConf(object):
                     ret.append(False)
             return ret
 
+    def dedup_endpoints(self, job):
+        dedup = False
+        try:
+            dedup = eval(self._jobs[job]['TopoDedupEndpoints'])
+        except KeyError:
+            pass
+
+        return dedup
+
     def get_mapfeedjobs(self, caller, name=None, deffeed=None):
         feeds = {}
         for c in self.get_customers():
@@ -1,10 +1,12 @@
 import datetime
+import itertools
 import re
 import time
 
 strerr = ''
 num_excp_expand = 0
 daysback = 1
+_interned = dict()
 
 class retry:
     def __init__(self, func):
@@ -24,9 +26,9 @@ class retry:
         result = None
         logger = args[0]
         objname = args[1]
-        self.numr = int(args[2]['ConnectionRetry'.lower()])
-        self.sleepretry = int(args[2]['ConnectionSleepRetry'.lower()])
-        loops = self.numr + 1
+        numr = int(args[2]['ConnectionRetry'.lower()])
+        sleepretry = int(args[2]['ConnectionSleepRetry'.lower()])
+        loops = numr + 1
         try:
             i = 1
             while i <= range(loops):
@@ -39,8 +41,8 @@ class retry:
                         logger.warn('%s %s() Customer:%s Job:%s Retry:%d Sleeping:%d - %s' %
                                     (objname, self.func.__name__,
                                      logger.customer, logger.job,
-                                     i, self.sleepretry, repr(e)))
-                        time.sleep(self.sleepretry)
+                                     i, sleepretry, repr(e)))
+                        time.sleep(sleepretry)
                         pass
                 else:
                     break
@@ -75,3 +77,117 @@ def module_class_name(obj):
     name = repr(obj.__class__.__name__)
 
     return name.replace("'",'')
+
+def intern_value(value):
+    """
+       Return single shared instance of value that repeats across many
+       entities, like service type, scope, NGI name or flag.
+    """
+    return _interned.setdefault(value, value)
+
+class TopoTags(object):
+    """
+       Read-only dict-like view of the tags of TopoEntity.
+    """
+    __slots__ = ('names', 'values')
+
+    def __init__(self, names, values):
+        self.names = names
+        self.values = values
+
+    def __getitem__(self, key):
+        try:
+            return self.values[self.names.index(key)]
+        except ValueError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.names
+
+    def iteritems(self):
+        return itertools.izip(self.names, self.values)
+
+    def keys(self):
+        return list(self.names)
+
+    def todict(self):
+        return dict(itertools.izip(self.names, self.values))
+
+class TopoEntity(object):
+    """
+       Compact topology entity. Fields are kept in slots with repeating
+       values interned and tags as tuple of values whose names are shared by
+       all entities of a kind. Entity is read as dict by topology filters
+       and turned into dict only when it is serialized. Only tags listed in
+       interntags repeat enough to be interned, others like URL of endpoint
+       are kept as they are.
+    """
+    __slots__ = ('tagnames', 'tagvalues')
+    fields = ()
+    interntags = frozenset(['scope', 'monitored', 'production', 'certification', 'infrastructure'])
+
+    def __init__(self, tagnames, tagvalues, **fields):
+        self.tagnames = tagnames
+        self.tagvalues = tuple(intern_value(v) if n in self.interntags else v
+                               for n, v in itertools.izip(tagnames, tagvalues))
+        for field in self.fields:
+            value = fields.get(field, None)
+            if field != 'hostname' and value is not None:
+                value = intern_value(value)
+            setattr(self, field, value)
+
+    def __getitem__(self, key):
+        if key == 'tags':
+            return TopoTags(self.tagnames, self.tagvalues)
+        if key in self.fields:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key == 'tags' or (key in self.fields and getattr(self, key) is not None)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def with_tag(self, name, value):
+        """
+           Return copy of entity with the value of given tag replaced.
+        """
+        tagvalues = tuple(value if n == name else v
+                          for n, v in itertools.izip(self.tagnames, self.tagvalues))
+        fields = dict((field, getattr(self, field)) for field in self.fields)
+
+        return self.__class__(self.tagnames, tagvalues, **fields)
+
+    def todict(self):
+        entity = dict((field, getattr(self, field)) for field in self.fields
+                      if getattr(self, field) is not None)
+        entity['tags'] = dict(itertools.izip(self.tagnames, self.tagvalues))
+
+        return entity
+
+    def __eq__(self, other):
+        if isinstance(other, TopoEntity):
+            other = other.todict()
+        return self.todict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.todict())
+
+class GroupOfGroups(TopoEntity):
+    __slots__ = ('type', 'group', 'subgroup')
+    fields = __slots__
+
+class GroupOfEndpoints(TopoEntity):
+    __slots__ = ('type', 'group', 'service', 'hostname', 'group_monitored')
+    fields = __slots__
@@ -1,21 +1,369 @@
 import base64
+import errno
+import hashlib
 import json
+import marshal
+import os
 import requests
 import socket
-import xml.dom.minidom
+import threading
+import time
+import xml.etree.cElementTree as etree
 
 from argo_egi_connectors.helpers import retry
 
-from xml.parsers.expat import ExpatError
+from io import BytesIO
+from requests.adapters import HTTPAdapter
+
 from urlparse import urlparse
 
+try:
+    import lxml.etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+try:
+    import ujson as fastjson
+except ImportError:
+    try:
+        import simplejson as fastjson
+    except ImportError:
+        fastjson = None
+
+
+POOLSIZE = 10
+MAXPERHOST = 4
+CHUNKSIZE = 64 * 1024
+
+_sessions = dict()
+_lock = threading.Lock()
+_host_slots = dict()
+_parsers = dict()
+_flights = dict()
+_pruned = set()
+
 
 class ConnectorError(Exception):
     pass
 
 
+class ReadError(ConnectorError):
+    """
+       Body of streamed response could not be read to the end because
+       connection broke or timed out during the transfer.
+    """
+    pass
+
+
+def get_session(globopts, scheme, host, headers):
+    """
+       Return requests.Session kept for the whole run and shared between all
+       connections to the same peer with the same credentials so that TCP
+       connections and TLS sessions are reused.
+    """
+    if scheme.startswith('https'):
+        cert = (globopts['AuthenticationHostCert'.lower()],
+                globopts['AuthenticationHostKey'.lower()])
+    else:
+        cert = None
+
+    key = (scheme, host, cert, tuple(sorted(headers.items())))
+
+    with _lock:
+        session = _sessions.get(key, None)
+        if not session:
+            poolsize = int(globopts.get('ConnectionPoolSize'.lower(), POOLSIZE))
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolsize)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update(headers)
+            session.cert = cert
+            _sessions[key] = session
+
+    return session
+
+
+def get_host_slots(globopts, host):
+    """
+       Return semaphore that caps the number of concurrent requests to a
+       single host regardless of how many threads are fetching from it.
+       Streamed request keeps its slot until its body is read.
+    """
+    with _lock:
+        slots = _host_slots.get(host, None)
+        if not slots:
+            maxperhost = int(globopts.get('ConnectionMaxPerHost'.lower(), MAXPERHOST))
+            slots = threading.BoundedSemaphore(maxperhost)
+            _host_slots[host] = slots
+
+    return slots
+
+
+def request_key(globopts, scheme, host, url, custauth=None):
+    """
+       Identity of request made with connection(), that is full URL and
+       credentials the peer will see.
+    """
+    return (scheme, host, url,
+            globopts.get('AuthenticationHostCert'.lower(), None),
+            globopts.get('AuthenticationHostKey'.lower(), None),
+            repr(sorted(custauth.items())) if custauth else None)
+
+
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def single_flight(key, fetch):
+    """
+       Call fetch() only once in the process for given key. Concurrent and
+       later callers with the same key wait for and reuse its result.
+       Failed fetch is not kept so the next caller will try again.
+    """
+    with _lock:
+        flight = _flights.get(key, None)
+        owner = flight is None
+        if owner:
+            flight = Flight()
+            _flights[key] = flight
+
+    if owner:
+        try:
+            flight.result = fetch()
+        except Exception as e:
+            flight.error = e
+            with _lock:
+                del _flights[key]
+            raise
+        finally:
+            flight.done.set()
+
+    flight.done.wait()
+    if flight.error:
+        raise flight.error
+
+    return flight.result
+
+
+def state_path(globopts, kind, key):
+    """
+       Return path of file under InputStateSaveDir that keeps state of given
+       kind between runs for the entity identified by key.
+    """
+    dirname = os.path.join(globopts['InputStateSaveDir'.lower()], kind)
+    try:
+        os.makedirs(dirname)
+    except OSError as e:
+        if e.args[0] != errno.EEXIST:
+            raise e
+
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+
+    return os.path.join(dirname, hashlib.sha1(key).hexdigest())
+
+
+def prune_state(globopts, kind):
+    """
+       Remove files of given kind under InputStateSaveDir that were not
+       updated for InputStateDays days. Done once per run for each kind.
+    """
+    dirname = os.path.join(globopts['InputStateSaveDir'.lower()], kind)
+    with _lock:
+        if dirname in _pruned:
+            return
+        _pruned.add(dirname)
+
+    try:
+        names = os.listdir(dirname)
+    except OSError:
+        return
+
+    oldest = time.time() - int(globopts.get('InputStateDays'.lower(), 3)) * 24 * 3600
+    for name in names:
+        try:
+            path = os.path.join(dirname, name)
+            if os.path.getmtime(path) < oldest:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+class ResponseCache(object):
+    """
+       On-disk cache of response bodies together with their ETag and
+       Last-Modified validators. Validators are sent with the next request
+       of the same URL and on 304 Not Modified body is served locally.
+       Entries not used for InputStateDays days are removed.
+    """
+    def __init__(self, globopts, url, headers):
+        prune_state(globopts, 'responses')
+        path = state_path(globopts, 'responses', url + repr(sorted(headers.items())))
+        self.meta = path + '.meta'
+        self.body = path + '.body'
+        self.url = url
+
+    def validators(self):
+        try:
+            with open(self.meta) as fp:
+                meta = json.load(fp)
+        except (IOError, ValueError):
+            return dict()
+
+        if not os.path.exists(self.body):
+            return dict()
+
+        headers = dict()
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last-modified'):
+            headers['If-Modified-Since'] = meta['last-modified']
+
+        return headers
+
+    def load(self, stream):
+        for f in [self.meta, self.body]:
+            os.utime(f, None)
+        if stream:
+            return open(self.body, 'rb')
+        else:
+            with open(self.body, 'rb') as fp:
+                return fp.read()
+
+    def writer(self, response):
+        """
+           Return CacheWriter for response that carries validators or None if
+           there is nothing to cache by and stale entry is dropped.
+        """
+        meta = {'url': self.url,
+                'etag': response.headers.get('etag', None),
+                'last-modified': response.headers.get('last-modified', None)}
+        if not meta['etag'] and not meta['last-modified']:
+            self.invalidate()
+            return None
+
+        try:
+            return CacheWriter(self, meta)
+        except IOError:
+            return None
+
+    def invalidate(self):
+        for f in [self.meta, self.body]:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+
+class CacheWriter(object):
+    def __init__(self, cache, meta):
+        self.cache = cache
+        self.meta = meta
+        self.tmp = '%s.%d.%d.tmp' % (cache.body, os.getpid(), threading.current_thread().ident)
+        self.fp = open(self.tmp, 'wb')
+
+    def write(self, data):
+        """
+           Response is not cached if its body can not be written, but it is
+           still served.
+        """
+        if not self.fp:
+            return
+        try:
+            self.fp.write(data)
+        except IOError:
+            self.discard()
+
+    def commit(self):
+        if not self.fp:
+            return
+        try:
+            self.fp.close()
+            os.rename(self.tmp, self.cache.body)
+            with open(self.tmp, 'w') as fp:
+                json.dump(self.meta, fp)
+            os.rename(self.tmp, self.cache.meta)
+        except (IOError, OSError):
+            self.fp = None
+            self.cache.invalidate()
+            self.discard()
+
+    def discard(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
+
+
+class ResponseStream(object):
+    """
+       File-like object over the body of streamed response. Body is read
+       from the network in chunks only as the consumer asks for data, so
+       parser can work on the first records while the rest is still being
+       transferred and the whole body is never kept in memory.
+    """
+    def __init__(self, response, chunksize=CHUNKSIZE, cache=None, slots=None):
+        self._response = response
+        self._chunks = response.iter_content(chunk_size=chunksize)
+        self._buf = b''
+        self._cache = cache
+        self._slots = slots
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            try:
+                chunk = next(self._chunks)
+                if self._cache:
+                    self._cache.write(chunk)
+                self._buf += chunk
+            except StopIteration:
+                if self._cache:
+                    self._cache.commit()
+                    self._cache = None
+                self.close()
+                break
+
+        if size < 0:
+            data, self._buf = self._buf, b''
+        else:
+            data, self._buf = self._buf[:size], self._buf[size:]
+
+        return data
+
+    def empty(self):
+        """
+           Read the first chunk of body to tell whether response is empty.
+        """
+        try:
+            while not self._buf:
+                chunk = next(self._chunks)
+                if self._cache:
+                    self._cache.write(chunk)
+                self._buf += chunk
+        except StopIteration:
+            return True
+
+        return False
+
+    def close(self):
+        if self._cache:
+            self._cache.discard()
+            self._cache = None
+        self._response.close()
+        if self._slots:
+            self._slots.release()
+            self._slots = None
+
+
 @retry
-def connection(logger, msgprefix, globopts, scheme, host, url, custauth=None):
+def connection(logger, msgprefix, globopts, scheme, host, url, custauth=None, stream=False):
     try:
         buf = None
 
@@ -28,19 +376,49 @@ def connection(logger, msgprefix, globopts, scheme, host, url, custauth=None):
                                         + custauth['AuthenticationHttpPass'.lower()])
             headers = {'Authorization': 'Basic ' + userpass}
 
-        if scheme.startswith('https'):
-            response = requests.get('https://' + host + url, headers=headers,
-                                    cert=(globopts['AuthenticationHostCert'.lower()],
-                                          globopts['AuthenticationHostKey'.lower()]),
-                                    verify=eval(globopts['AuthenticationVerifyServerCert'.lower()]),
-                                    timeout=int(globopts['ConnectionTimeout'.lower()]))
-            response.raise_for_status()
-        else:
-            response = requests.get('http://' + host + url, headers=headers,
-                                    timeout=int(globopts['ConnectionTimeout'.lower()]))
+        session = get_session(globopts, scheme, host, headers)
+
+        cache, validators = None, {}
+        if eval(globopts.get('InputStateCacheResponses'.lower(), 'True')):
+            try:
+                cache = ResponseCache(globopts, scheme + '://' + host + url, headers)
+                validators = cache.validators()
+            except (OSError, IOError) as e:
+                logger.warn('%sCustomer:%s Job:%s Responses not cached - %s' % (msgprefix + ' ' if msgprefix else '',
+                                                                                logger.customer, logger.job, repr(e)))
+                cache, validators = None, {}
 
+        # slot is held until streamed body is read, so body transfers are
+        # capped too
+        slots = get_host_slots(globopts, host)
+        slots.acquire()
+        try:
+            if scheme.startswith('https'):
+                response = session.get('https://' + host + url, headers=validators,
+                                       verify=eval(globopts['AuthenticationVerifyServerCert'.lower()]),
+                                       timeout=int(globopts['ConnectionTimeout'.lower()]),
+                                       stream=stream)
+                response.raise_for_status()
+            else:
+                response = session.get('http://' + host + url, headers=validators,
+                                       timeout=int(globopts['ConnectionTimeout'.lower()]),
+                                       stream=stream)
+        except Exception:
+            slots.release()
+            raise
+
+        if response.status_code != 200 or not stream:
+            slots.release()
+
+        if response.status_code == 304 and cache:
+            response.close()
+            try:
+                buf = cache.load(stream)
+            except IOError as e:
+                cache.invalidate()
+                raise requests.exceptions.RequestException('Not modified, but cached response unavailable - %s' % repr(e))
 
-        if response.status_code >= 300 and response.status_code < 400:
+        elif response.status_code >= 300 and response.status_code < 400:
             headers = response.headers
             location = filter(lambda h: 'location' in h[0], headers)
             if location:
@@ -48,12 +426,22 @@ def connection(logger, msgprefix, globopts, scheme, host, url, custauth=None):
             else:
                 raise requests.exceptions.RequestException('No Location header set for redirect')
 
-            return connection(logger, msgprefix, globopts, scheme, redir.netloc, redir.path + '?' + redir.query, custauth=custauth)
+            return connection(logger, msgprefix, globopts, scheme, redir.netloc, redir.path + '?' + redir.query, custauth=custauth, stream=stream)
+
+        elif response.status_code == 200 and stream:
+            buf = ResponseStream(response, cache=cache.writer(response) if cache else None, slots=slots)
+            if buf.empty():
+                buf.close()
+                raise requests.exceptions.RequestException('Empty response')
 
         elif response.status_code == 200:
             buf = response.content
             if not buf:
                 raise requests.exceptions.RequestException('Empty response')
+            writer = cache.writer(response) if cache else None
+            if writer:
+                writer.write(buf)
+                writer.commit()
 
         else:
             raise requests.exceptions.RequestException('response: %s %s' % (response.status_code, response.reason))
@@ -94,11 +482,93 @@ def connection(logger, msgprefix, globopts, scheme, host, url, custauth=None):
         return False
 
 
+@retry
+def _read_feed(logger, msgprefix, globopts, fetch):
+    try:
+        return True, fetch()
+    except ReadError as e:
+        raise e
+    except Exception as e:
+        return False, e
+
+
+def fetch_streamed(logger, msgprefix, globopts, fetch):
+    """
+       Call fetch() that requests feed with connection(stream=True) and
+       parses it while it is being downloaded. If the transfer of the body
+       breaks, feed is requested and parsed again as many times as
+       connection() retries the request.
+    """
+    ret = _read_feed(logger, msgprefix, globopts, fetch)
+    if not ret:
+        raise ConnectorError()
+
+    ok, result = ret
+    if not ok:
+        raise result
+
+    return result
+
+
+class XmlParser(object):
+    """
+       fromstring() and iterparse() of ElementTree compatible module. lxml
+       is told not to resolve entities nor to access network, so feed cannot
+       pull local files or remote documents into parsed records.
+    """
+    def __init__(self, mod):
+        self.mod = mod
+        self.name = mod.__name__
+        if lxml_etree is not None and mod is lxml_etree:
+            self._opts = dict(resolve_entities=False, no_network=True)
+        else:
+            self._opts = dict()
+
+    def fromstring(self, buf):
+        if self._opts:
+            return self.mod.fromstring(buf, self.mod.XMLParser(**self._opts))
+        else:
+            return self.mod.fromstring(buf)
+
+    def iterparse(self, source, events):
+        return self.mod.iterparse(source, events=events, **self._opts)
+
+
+def get_parsers(logger, globopts):
+    """
+       Return XmlParser over module compatible with ElementTree API, its
+       parse error and JSON module that will be used for parsing feeds.
+       C-accelerated lxml and ujson/simplejson are picked if they are
+       installed, unless Parser.Backend in global.conf asks for stdlib.
+    """
+    backend = globopts.get('ParserBackend'.lower(), 'auto').strip().lower()
+
+    with _lock:
+        parsers = _parsers.get(backend, None)
+        if not parsers:
+            if backend != 'stdlib' and lxml_etree is not None:
+                xmlmod, xmlerror = lxml_etree, lxml_etree.XMLSyntaxError
+            else:
+                xmlmod, xmlerror = etree, etree.ParseError
+            if backend != 'stdlib' and fastjson is not None:
+                jsonmod = fastjson
+            else:
+                jsonmod = json
+            parsers = (XmlParser(xmlmod), xmlerror, jsonmod)
+            _parsers[backend] = parsers
+            logger.info('Parser backend %s: XML with %s, JSON with %s' % (backend, xmlmod.__name__,
+                                                                          jsonmod.__name__))
+
+    return parsers
+
+
 def parse_xml(logger, objname, globopts, buf, method):
+    xmlmod, xmlerror, _ = get_parsers(logger, globopts)
+
     try:
-        doc = xml.dom.minidom.parseString(buf)
+        doc = xmlmod.fromstring(buf)
 
-    except ExpatError as e:
+    except xmlerror as e:
         logger.error(objname + ' Customer:%s Job:%s : Error parsing XML feed %s - %s' % (logger.customer, logger.job, method, repr(e)))
         raise ConnectorError()
 
@@ -110,9 +580,102 @@ def parse_xml(logger, objname, globopts, buf, method):
         return doc
 
 
+def cached_records(globopts, key, buf, parse):
+    """
+       Return list of records that parse() extracts from buffered raw data.
+       Records are kept in InputStateSaveDir together with the hash of raw
+       data they are extracted from, so parsing is skipped for data that did
+       not change since the last run.
+    """
+    savedir = globopts.get('InputStateSaveDir'.lower(), None)
+    if (not savedir or not isinstance(buf, str)
+        or not eval(globopts.get('InputStateCacheRecords'.lower(), 'True'))):
+        return list(parse(buf))
+
+    try:
+        path = state_path(globopts, 'records', key)
+    except OSError:
+        return list(parse(buf))
+
+    digest = hashlib.sha1(buf).hexdigest()
+    try:
+        with open(path, 'rb') as fp:
+            cached = marshal.load(fp)
+        if cached[0] == digest:
+            return cached[1]
+    except (IOError, EOFError, ValueError, TypeError, IndexError):
+        pass
+
+    records = list(parse(buf))
+
+    tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+    try:
+        with open(tmp, 'wb') as fp:
+            marshal.dump((digest, records), fp)
+        os.rename(tmp, path)
+    except (IOError, OSError, ValueError):
+        pass
+
+    return records
+
+
+def parse_xml_records(logger, objname, globopts, buf, method, tag, extract):
+    """
+       Generator that parses XML feed in a single pass and yields flat record
+       built by extract() for every element with given tag as soon as the
+       element is parsed. Element is freed right after so memory is bound by
+       the size of the largest record and not the size of the feed. Feed is
+       either buffered data or ResponseStream that is parsed while being
+       downloaded. Feed is closed once the generator is done with it.
+    """
+    xmlmod, xmlerror, _ = get_parsers(logger, globopts)
+
+    if isinstance(buf, basestring):
+        buf = BytesIO(buf)
+
+    try:
+        for record in _parse_xml_records(logger, objname, xmlmod, xmlerror, buf, method, tag, extract):
+            yield record
+    finally:
+        buf.close()
+
+
+def _parse_xml_records(logger, objname, xmlmod, xmlerror, buf, method, tag, extract):
+    try:
+        context = iter(xmlmod.iterparse(buf, events=('start', 'end')))
+        event, root = next(context)
+    except StopIteration:
+        return
+    except xmlerror as e:
+        logger.error(objname + ' Customer:%s Job:%s : Error parsing XML feed %s - %s' % (logger.customer, logger.job, method, repr(e)))
+        raise ConnectorError()
+    except (requests.exceptions.RequestException, socket.error) as e:
+        logger.warn(objname + ' Customer:%s Job:%s : Error reading XML feed %s - %s' % (logger.customer, logger.job, method, repr(e)))
+        raise ReadError(repr(e))
+
+    while True:
+        try:
+            event, elem = next(context)
+        except StopIteration:
+            break
+        except xmlerror as e:
+            logger.error(objname + ' Customer:%s Job:%s : Error parsing XML feed %s - %s' % (logger.customer, logger.job, method, repr(e)))
+            raise ConnectorError()
+        except (requests.exceptions.RequestException, socket.error) as e:
+            logger.warn(objname + ' Customer:%s Job:%s : Error reading XML feed %s - %s' % (logger.customer, logger.job, method, repr(e)))
+            raise ReadError(repr(e))
+
+        if event == 'end' and elem.tag == tag:
+            yield extract(elem)
+            elem.clear()
+            root.clear()
+
+
 def parse_json(logger, objname, globopts, buf, method):
+    _, _, jsonmod = get_parsers(logger, globopts)
+
     try:
-        doc = json.loads(buf)
+        doc = jsonmod.loads(buf)
 
     except ValueError as e:
         logger.error(objname + ' Customer:%s Job:%s : Error parsing JSON feed %s - %s' % (logger.customer, logger.job, method, repr(e)))
@@ -124,3 +687,84 @@ def parse_json(logger, objname, globopts, buf, method):
 
     else:
         return doc
+
+
+def _json_array(source):
+    """
+       Generator that decodes elements of JSON array at the top level one by
+       one reading source in chunks. Raises ValueError on malformed data.
+    """
+    decoder = json.JSONDecoder()
+    data, pos, eof = '', 0, False
+
+    def more(data, pos):
+        chunk = source.read(CHUNKSIZE)
+        return data[pos:] + chunk, 0, not chunk
+
+    while not eof and not data.strip():
+        data, pos, eof = more(data, pos)
+    data = data.lstrip()
+    if not data.startswith('['):
+        raise ValueError('Expected array at the top level')
+    pos = 1
+
+    while True:
+        while pos < len(data) and data[pos] in ' \t\r\n,':
+            pos += 1
+        if pos == len(data):
+            if eof:
+                raise ValueError('Unterminated array')
+            data, pos, eof = more(data, pos)
+            continue
+        if data[pos] == ']':
+            break
+
+        try:
+            elem, end = decoder.raw_decode(data, pos)
+            if end == len(data) and not eof:
+                raise ValueError('Element possibly truncated')
+        except ValueError:
+            if eof:
+                raise
+            data, pos, eof = more(data, pos)
+            continue
+
+        pos = end
+        yield elem
+
+
+def parse_json_records(logger, objname, globopts, buf, method, extract):
+    """
+       Generator that incrementally decodes JSON feed with array at the top
+       level and yields extract() of one array element at a time. Feed is
+       either buffered data, ResponseStream or opened file and it is read in
+       chunks, so memory is bound by the size of the largest element and by
+       the fields that extract() keeps and not by the size of the feed.
+       Feed is closed once the generator is done with it.
+    """
+    if isinstance(buf, basestring):
+        buf = BytesIO(buf)
+
+    try:
+        for record in _parse_json_records(logger, objname, buf, method, extract):
+            yield record
+    finally:
+        buf.close()
+
+
+def _parse_json_records(logger, objname, buf, method, extract):
+    elements = _json_array(buf)
+
+    while True:
+        try:
+            elem = next(elements)
+        except StopIteration:
+            break
+        except ValueError as e:
+            logger.error(objname + ' Customer:%s Job:%s : Error parsing JSON feed %s - %s' % (logger.customer, logger.job, method, repr(e)))
+            raise ConnectorError()
+        except (requests.exceptions.RequestException, socket.error) as e:
+            logger.warn(objname + ' Customer:%s Job:%s : Error reading JSON feed %s - %s' % (logger.customer, logger.job, method, repr(e)))
+            raise ReadError(repr(e))
+
+        yield extract(elem)
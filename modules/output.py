@@ -1,12 +1,22 @@
 import datetime
+import hashlib
 import os
 import json
+import threading
+import time
 
 import avro.schema
 from avro.datafile import DataFileWriter
-from avro.io import DatumWriter, BinaryEncoder
+from avro.io import DatumWriter, BinaryEncoder, AvroTypeException, validate
 
+from collections import deque
 from io import BytesIO
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fastavro
+except ImportError:
+    fastavro = None
 
 from argo_egi_connectors.helpers import datestamp, retry, module_class_name
 from argo_egi_connectors.log import Logger
@@ -15,6 +25,11 @@ from argo_ams_library import AmsMessage, ArgoMessagingService, AmsException
 
 
 daysback = 1
+AMSBULKBYTES = 4 * 1024 * 1024
+AMSMAXINFLIGHT = 4
+
+_lock = threading.Lock()
+_schemas = dict()
 
 
 class AvroWriter:
@@ -24,27 +39,42 @@ class AvroWriter:
         self.outfile = outfile
         self.datawrite = None
         self.avrofile = None
+        self.lschema = None
         self._load_datawriter()
 
     def _load_datawriter(self):
         try:
-            lschema = load_schema(self.schema)
+            self.lschema = load_schema(self.schema)
             self.avrofile = open(self.outfile, 'w+')
-            self.datawrite = DataFileWriter(self.avrofile, DatumWriter(), lschema)
         except Exception:
             return False
 
         return True
 
+    def _new_datawriter(self, data):
+        """
+           DataFileWriter is created once data is known as it decides on
+           datum writer. AvroData datums are already encoded.
+        """
+        if isinstance(data, AvroData):
+            return DataFileWriter(self.avrofile, RawDatumWriter(), self.lschema)
+        else:
+            return DataFileWriter(self.avrofile, new_datum_writer(), self.lschema)
+
     def write(self, data):
         try:
 
-            if (not self.datawrite or
+            if (not self.lschema or
                 not self.avrofile):
                 raise ('AvroFileWriter not initalized')
 
+            if not self.datawrite:
+                self.datawrite = self._new_datawriter(data)
+            if isinstance(data, AvroData):
+                data = data.datums
+
             for elem in data:
-                self.datawrite.append(elem)
+                self.datawrite.append(avro_datum(elem))
 
             self.datawrite.close()
             self.avrofile.close()
@@ -57,13 +87,20 @@ class AvroWriter:
 
 class AmsPublish(object):
     """
-       Class represents interaction with AMS service
+       Class represents interaction with AMS service. With maxinflight
+       greater than 1 several batches are published at once and AMS does
+       not get messages in the order they are given.
     """
     def __init__(self, host, project, token, topic, report, bulk, packsingle,
-                 logger, retry, timeout=180, sleepretry=60):
+                 logger, retry, timeout=180, sleepretry=60, bulkbytes=AMSBULKBYTES,
+                 maxinflight=AMSMAXINFLIGHT, statedir=None, savedays=None):
         self.ams = ArgoMessagingService(host, token, project)
         self.topic = topic
         self.bulk = int(bulk)
+        self.bulkbytes = int(bulkbytes)
+        self.maxinflight = max(1, int(maxinflight))
+        self.statedir = statedir
+        self.savedays = savedays
         self.report = report
         self.timeout = int(timeout)
         self.retry = int(retry)
@@ -71,75 +108,335 @@ class AmsPublish(object):
         self.logger = logger
         self.packsingle = eval(packsingle)
 
+    def _publish(self, batch, timeout):
+        started = time.time()
+        ret = self.ams.publish(self.topic, batch, timeout=timeout)
+        msgids = ret.get('messageIds', []) if isinstance(ret, dict) else []
+
+        return time.time() - started, msgids
+
     @staticmethod
     @retry
-    def _send(logger, msgprefix, retryopts, msgs, bulk, obj):
+    def _send(logger, msgprefix, retryopts, batches, obj):
+        """
+           Keeps up to obj.maxinflight batches being published at once. After
+           the first failed batch no new ones are started, those in flight are
+           waited for and error is raised so that retry publishes only the
+           batches that did not make it.
+        """
         timeout = retryopts['ConnectionTimeout'.lower()]
-        try:
-            if bulk > 1:
-                q, r = divmod(len(msgs), bulk)
-
-                if q:
-                    s = 0
-                    e = bulk - 1
+        inflight = deque()
+        error = None
 
-                    for i in range(q):
-                        obj.ams.publish(obj.topic, msgs[s:e], timeout=timeout)
-                        s += bulk
-                        e += bulk
-                    obj.ams.publish(obj.topic, msgs[s:], timeout=timeout)
-
-                else:
-                    obj.ams.publish(obj.topic, msgs, timeout=timeout)
-
-            else:
-                obj.ams.publish(obj.topic, msgs, timeout=timeout)
-
-        except AmsException as e:
-            raise e
+        pool = ThreadPool(obj.maxinflight)
+        try:
+            batches.rewind()
+            while True:
+                while not error and len(inflight) < obj.maxinflight:
+                    span = batches.next_batch()
+                    if not span:
+                        break
+                    inflight.append((span, pool.apply_async(obj._publish, (batches.batch(span), timeout))))
+                if not inflight:
+                    break
+
+                done, result = inflight.popleft()
+                try:
+                    batches.published(done, *result.get())
+                except Exception as e:
+                    logger.warn('%s Customer:%s Job:%s Failed to publish messages %d-%d - %s' %
+                                (msgprefix, logger.customer, logger.job, done[0], done[1] - 1, repr(e)))
+                    batches.failed()
+                    error = e
+        finally:
+            pool.close()
+            pool.join()
+
+        if error:
+            raise error
 
         return True
 
     def send(self, schema, msgtype, date, msglist):
-        def _avro_serialize(msg):
-            opened_schema = load_schema(schema)
-            avro_writer = DatumWriter(opened_schema)
-            bytesio = BytesIO()
-            encoder = BinaryEncoder(bytesio)
-            if isinstance(msg, list):
-                for m in msg:
-                    avro_writer.write(m, encoder)
-            else:
-                avro_writer.write(msg, encoder)
-
-            return bytesio.getvalue()
+        if isinstance(msglist, AvroData):
+            datums = msglist.datums
+        else:
+            datums = encode_datums(schema, msglist)
 
         if self.packsingle:
             self.bulk = 1
             msg = AmsMessage(attributes={'partition_date': date,
                                          'report': self.report,
                                          'type': msgtype},
-                             data=_avro_serialize(msglist))
+                             data=''.join(datums))
             msgs = [msg]
 
         else:
-            msgs = map(lambda m: AmsMessage(attributes={'partition_date': date,
+            msgs = map(lambda d: AmsMessage(attributes={'partition_date': date,
                                                         'report': self.report,
                                                         'type': msgtype},
-                                            data=_avro_serialize(m)), msglist)
+                                            data=d), datums)
+
+        ledger = None
+        if self.statedir:
+            if self.savedays:
+                prune_ledgers(self.statedir, date, self.savedays)
+            ledger = PublishLedger(os.path.join(self.statedir, 'ams-%s_%s' % (msgtype, date.replace('-', '_'))),
+                                   self.topic)
+
+        batches = PublishBatches(msgs, self.bulk, self.bulkbytes, self.timeout / 4.0, ledger)
+        try:
+            if self._send(self.logger, module_class_name(self),
+                          {'ConnectionRetry'.lower(): self.retry,
+                           'ConnectionTimeout'.lower(): self.timeout,
+                           'ConnectionSleepRetry'.lower(): self.sleepretry}, batches, self):
+                if ledger:
+                    ledger.remove()
+                return True
+        finally:
+            if ledger:
+                ledger.close()
+
+
+class PublishBatches(object):
+    """
+       Messages split into batches of at most maxcount messages and maxbytes
+       of JSON encoded payload, single message bigger than maxbytes is sent
+       in a batch of its own. Number of messages in the batch is halved
+       after failed publish or publish slower than latency seconds and is
+       increased back while publishes are fast. Published messages are
+       marked so batches handed out after rewind() cover only messages that
+       are not published yet. If ledger is given, messages it acknowledged
+       in previous run are marked as published right away.
+    """
+    def __init__(self, msgs, maxcount, maxbytes, latency, ledger=None):
+        self.msgs = msgs
+        self.maxcount = max(1, maxcount)
+        self.maxbytes = maxbytes
+        self.latency = latency
+        self.limit = self.maxcount
+        self.ledger = ledger
+        self._cursor = 0
+        self._sent = [False] * len(msgs)
+        self._sizes = list()
+        self._hashes = list()
+        for m in msgs:
+            encoded = json.dumps(m.dict(), sort_keys=True)
+            self._sizes.append(len(encoded) + 1)
+            if ledger:
+                self._hashes.append(ledger.msghash(encoded))
+
+        if ledger:
+            acked = ledger.load()
+            for i, h in enumerate(self._hashes):
+                if acked.get(h, 0):
+                    acked[h] -= 1
+                    self._sent[i] = True
+
+    def rewind(self):
+        self._cursor = 0
+
+    def next_batch(self):
+        start = self._cursor
+        while start < len(self.msgs) and self._sent[start]:
+            start += 1
+        end = start
+        size = 0
+        while (end < len(self.msgs) and not self._sent[end] and
+               end - start < self.limit):
+            if end > start and size + self._sizes[end] > self.maxbytes:
+                break
+            size += self._sizes[end]
+            end += 1
+        self._cursor = end
+
+        return (start, end) if end > start else None
+
+    def batch(self, span):
+        return self.msgs[span[0]:span[1]]
+
+    def published(self, span, elapsed, msgids=None):
+        for i in xrange(span[0], span[1]):
+            self._sent[i] = True
+        if self.ledger:
+            self.ledger.record(self._hashes[span[0]:span[1]], msgids or [])
+        if elapsed > self.latency:
+            self.limit = max(1, self.limit / 2)
+        else:
+            self.limit = min(self.maxcount, self.limit + max(1, self.maxcount / 4))
+
+    def failed(self):
+        self.limit = max(1, self.limit / 2)
+
+
+class PublishLedger(object):
+    """
+       Messages acknowledged by AMS, each recorded by the hash of the
+       message and the topic together with the message ID that AMS
+       assigned to it. Ledger is appended to after every published batch
+       so publish interrupted by error or by exit of connector can be
+       resumed without publishing the same messages again.
+    """
+    def __init__(self, path, topic):
+        self.path = path
+        self.topic = topic
+        self._fp = None
+
+    def msghash(self, encoded):
+        return hashlib.sha1(self.topic + '\0' + encoded).hexdigest()
+
+    def load(self):
+        acked = dict()
+        try:
+            with open(self.path) as fp:
+                for line in fp:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        acked[fields[0]] = acked.get(fields[0], 0) + 1
+        except IOError:
+            pass
+
+        return acked
+
+    def record(self, hashes, msgids):
+        if not self._fp:
+            self._fp = open(self.path, 'a')
+        for i, h in enumerate(hashes):
+            self._fp.write('%s %s\n' % (h, msgids[i] if i < len(msgids) else '-'))
+        self._fp.flush()
+
+    def close(self):
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def prune_ledgers(statedir, date, savedays):
+    """
+       Remove ledgers of publishes that never completed and are more than
+       savedays older than given date, like write_state() does with its
+       state files.
+    """
+    dateold = datetime.datetime.strptime(date, '%Y-%m-%d') - datetime.timedelta(days=int(savedays))
+    for filename in os.listdir(statedir):
+        if not filename.startswith('ams-'):
+            continue
+        try:
+            if datetime.datetime.strptime(filename[-10:], '%Y_%m_%d') < dateold:
+                os.remove(os.path.join(statedir, filename))
+        except (ValueError, OSError):
+            pass
+
+
+class AvroData(object):
+    """
+       Records encoded into Avro datums only once, so the same bytes are
+       published to AMS and written into avro file.
+    """
+    def __init__(self, schema, data):
+        self.schema = schema
+        self.datums = encode_datums(schema, data)
+
+    def __len__(self):
+        return len(self.datums)
+
+
+def encode_datums(schema, data):
+    avro_writer = datum_writer(schema)
+    bytesio = BytesIO()
+    encoder = BinaryEncoder(bytesio)
+    datums = list()
+
+    for elem in data:
+        bytesio.seek(0)
+        bytesio.truncate()
+        if isinstance(elem, list):
+            for e in elem:
+                avro_writer.write(avro_datum(e), encoder)
+        else:
+            avro_writer.write(avro_datum(elem), encoder)
+        datums.append(bytesio.getvalue())
+
+    return datums
+
+
+def avro_datum(elem):
+    """
+       Entities that connectors keep in compact form are turned into dicts
+       only when they are serialized.
+    """
+    return elem.todict() if hasattr(elem, 'todict') else elem
 
-        if self._send(self.logger, module_class_name(self),
-                      {'ConnectionRetry'.lower(): self.retry,
-                       'ConnectionTimeout'.lower(): self.timeout,
-                       'ConnectionSleepRetry'.lower(): self.sleepretry}, msgs, self.bulk, self):
-            return True
+
+class FastDatumWriter(DatumWriter):
+    """
+       DatumWriter that hands the encoding of datums over to fastavro's
+       schemaless writer, which produces the same bytes as avro.io. Datums
+       are validated against the schema as avro.io does since fastavro
+       does not.
+    """
+    def __init__(self, writers_schema=None):
+        DatumWriter.__init__(self, writers_schema)
+        self._parsedfor = None
+        self._parsed = None
+
+    def write(self, datum, encoder):
+        if not validate(self.writers_schema, datum):
+            raise AvroTypeException(self.writers_schema, datum)
+        if self._parsedfor is not self.writers_schema:
+            self._parsed = fastavro.parse_schema(self.writers_schema.to_json())
+            self._parsedfor = self.writers_schema
+        fastavro.schemaless_writer(encoder.writer, self._parsed, datum)
+
+
+class RawDatumWriter(DatumWriter):
+    """
+       DatumWriter for datums that are already encoded.
+    """
+    def write(self, datum, encoder):
+        encoder.write(datum)
+
+
+def new_datum_writer(schema=None):
+    """
+       fastavro is used to encode datums if it is installed, reference
+       avro.io implementation otherwise.
+    """
+    if fastavro is not None:
+        return FastDatumWriter(schema)
+    else:
+        return DatumWriter(schema)
+
+
+def _registered(schema):
+    """
+       Schema files are parsed once per process and kept together with the
+       DatumWriter prepared for them.
+    """
+    with _lock:
+        if schema not in _schemas:
+            with open(schema) as f:
+                parsed = avro.schema.parse(f.read())
+            _schemas[schema] = (parsed, new_datum_writer(parsed))
+
+        return _schemas[schema]
 
 
 def load_schema(schema):
     try:
-        f = open(schema)
-        schema = avro.schema.parse(f.read())
-        return schema
+        return _registered(schema)[0]
+    except Exception as e:
+        raise e
+
+
+def datum_writer(schema):
+    try:
+        return _registered(schema)[1]
     except Exception as e:
         raise e
 
@@ -44,6 +44,9 @@ class TestConfig(unittest.TestCase):
         self.assertEqual(merged, dict(amshost='host', amsproject='EGI',
                                       amstoken='token', amstopic='TOPIC',
                                       amsbulk='100', amspacksinglemsg='True'))
+        merged.update(amsbulkbytes='1048576')
+        complete, missing = self.globalconfig.is_complete(merged, 'ams')
+        self.assertTrue(complete)
 
     def testHttpAuthOpts(self):
         globalopts = self.globalconfig.parse()
@@ -69,6 +72,8 @@ class TestConfig(unittest.TestCase):
                                   'Scope': 'EGI'})
         getags = self.customerconfig.get_gocdb_getags(jobs[0])
         self.assertEqual(getags, {'Scope': 'EGI', 'Production': 'Y', 'Monitored': 'Y'})
+        self.assertFalse(self.customerconfig.dedup_endpoints(jobs[0]))
+        self.assertTrue(self.customerconfig.dedup_endpoints(jobs[1]))
         profiles = self.customerconfig.get_profiles(jobs[0])
         self.assertEqual(profiles, ['ARGO_MON_CRITICAL'])
         feedjobs = self.customerconfig.get_mapfeedjobs('topology-gocdb-connector.py',
@@ -1,12 +1,21 @@
 import datetime
 import httplib
+import json
 import mock
 import modules.config
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest2 as unittest
 
+from modules import input
+
 from bin.downtimes_gocdb_connector import GOCDBReader as DowntimesGOCDBReader
 from bin.downtimes_gocdb_connector import main as downtimes_main
-from bin.topology_gocdb_connector import GOCDBReader, TopoFilter
+from bin.topology_gocdb_connector import GOCDBReader, GroupOfEndpoints, TopoFilter, TopoIndex, TopoStore
+from bin.topology_gocdb_connector import dedup_endpoints, plan_pushdown
 from bin.weights_vapor_connector import Vapor as VaporReader
 from modules.log import Logger
 
@@ -601,14 +610,20 @@ class TopologyXml(unittest.TestCase):
         jobcust = feedjobs.values()[0]
         scopes = self.customerconfig.get_feedscopes(feed, jobcust)
         self.gocdbreader = GOCDBReader(feed, scopes)
-        self.orig_get_xmldata = self.gocdbreader._get_xmldata
-        self.gocdbreader._get_xmldata = self.wrap_get_xmldata
+        self.orig_get_rawdata = self.gocdbreader._get_rawdata
+        self.gocdbreader._get_rawdata = self.wrap_get_rawdata
+
+        self.statedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.statedir)
+        self.globopts['inputstatesavedir'] = self.statedir
+        self.orig_get_rawdata.im_func.func_globals['globopts'] = self.globopts
 
-    def wrap_get_xmldata(self, scope, pi):
+    def wrap_get_rawdata(self, scope, pi, **kwargs):
         globopts = self.globalconfig.parse()
-        self.orig_get_xmldata.im_func.func_globals['globopts'] = globopts
-        self.orig_get_xmldata.im_func.func_globals['input'].connection.func = self.mock_conn
-        return self.orig_get_xmldata(scope, pi)
+        globopts['inputstatesavedir'] = self.statedir
+        self.orig_get_rawdata.im_func.func_globals['globopts'] = globopts
+        self.orig_get_rawdata.im_func.func_globals['input'].connection.func = self.mock_conn
+        return self.orig_get_rawdata(scope, pi, **kwargs)
 
     @mock.patch('modules.input.connection')
     def testServiceEndpoints(self, mock_conn):
@@ -617,7 +632,7 @@ class TopologyXml(unittest.TestCase):
         mock_conn.return_value = self.group_endpoints_feed
         self.mock_conn = mock_conn
         self.gocdbreader.getServiceEndpoints(servicelist, '&scope=EGI')
-        self.gocdbreader.serviceListEGI = servicelist
+        self.gocdbreader.serviceList['EGI'] = servicelist
         self.gocdbreader.getGroupOfEndpoints.im_func.func_globals['fetchtype'] = 'SITES'
         sge = sorted(self.group_endpoints, key=lambda e: e['service'])
         obj_sge = sorted(self.gocdbreader.getGroupOfEndpoints(),
@@ -631,13 +646,72 @@ class TopologyXml(unittest.TestCase):
         mock_conn.return_value = self.group_endpoints_feed
         self.mock_conn = mock_conn
         self.gocdbreader.getServiceEndpoints(servicelist, '&scope=EGI')
-        self.gocdbreader.serviceListEGI = servicelist
+        self.gocdbreader.serviceList['EGI'] = servicelist
         self.gocdbreader.getGroupOfEndpoints.im_func.func_globals['fetchtype'] = 'SITES'
         sge = sorted(self.group_endpoints_uid, key=lambda e: e['service'])
         obj_sge = sorted(self.gocdbreader.getGroupOfEndpoints(True),
                          key=lambda e: e['service'])
         self.assertEqual(sge, obj_sge)
 
+    def testPagedServiceEndpoints(self):
+        meta = '<results>\n<meta>\n<count>%d</count>\n' \
+               '<link rel="self" href="https://localhost/gocdbpi/private/?method=get_service_endpoint&amp;next_cursor=%s"/>\n' \
+               '<link rel="next" href="https://localhost/gocdbpi/private/?method=get_service_endpoint&amp;next_cursor=%s&amp;scope=EGI"/>\n' \
+               '</meta>\n'
+        pages = {'0': self.group_endpoints_feed.replace('<results>\n', meta % (3, '0', '4497'), 1),
+                 '4497': '<?xml version="1.0" encoding="UTF-8"?>\n' + meta % (0, '4497', '4497') + '</results>'}
+        requested = list()
+
+        def get_rawdata(scope, pi):
+            cursor = pi.split('next_cursor=')[1]
+            requested.append(cursor)
+            return pages[cursor]
+
+        globopts = self.globalconfig.parse()
+        globopts['inputstatesavedir'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, globopts['inputstatesavedir'])
+        func_globals = self.orig_get_rawdata.im_func.func_globals
+        func_globals['globopts'] = globopts
+
+        servicelist = dict()
+        self.gocdbreader.paging = True
+        self.gocdbreader._get_rawdata = get_rawdata
+        self.gocdbreader.getServiceEndpoints(servicelist, '&scope=EGI')
+        self.assertEqual(requested, ['0', '4497'])
+
+        warmlist = dict()
+        with mock.patch.object(func_globals['input'], 'parse_xml_records') as parse:
+            self.gocdbreader.getServiceEndpoints(warmlist, '&scope=EGI')
+            self.assertFalse(parse.called)
+        self.assertEqual(warmlist, servicelist)
+
+        def get_rawdata_flaky(scope, pi):
+            cursor = pi.split('next_cursor=')[1]
+            requested.append(cursor)
+            if cursor == '4497':
+                raise input.ConnectorError()
+            return pages[cursor]
+
+        del requested[:]
+        func_globals['logger'] = mock.Mock(customer='EGI', job='JOB_EGICritical')
+        self.gocdbreader._get_rawdata = get_rawdata_flaky
+        self.assertRaises(input.ConnectorError, self.gocdbreader.getServiceEndpoints, dict(), '&scope=EGI')
+        self.gocdbreader._get_rawdata = get_rawdata
+        resumedlist = dict()
+        self.gocdbreader.getServiceEndpoints(resumedlist, '&scope=EGI')
+        self.assertEqual(requested, ['0', '4497', '4497'])
+        self.assertEqual(resumedlist, servicelist)
+        del requested[:]
+        self.gocdbreader.getServiceEndpoints(dict(), '&scope=EGI')
+        self.assertEqual(requested, ['0', '4497'])
+        self.gocdbreader.serviceList['EGI'] = servicelist
+        self.gocdbreader.fetched = True
+        self.gocdbreader.getGroupOfEndpoints.im_func.func_globals['fetchtype'] = 'SITES'
+        sge = sorted(self.group_endpoints, key=lambda e: e['service'])
+        obj_sge = sorted(self.gocdbreader.getGroupOfEndpoints(),
+                         key=lambda e: e['service'])
+        self.assertEqual(sge, obj_sge)
+
     @mock.patch('modules.input.connection')
     def testSites(self, mock_conn):
         siteslist = dict()
@@ -645,13 +719,160 @@ class TopologyXml(unittest.TestCase):
         mock_conn.return_value = self.group_groups_feed
         self.mock_conn = mock_conn
         self.gocdbreader.getSitesInternal(siteslist, '&scope=EGI')
-        self.gocdbreader.siteListEGI = siteslist
+        self.gocdbreader.siteList['EGI'] = siteslist
         self.gocdbreader.getGroupOfGroups.im_func.func_globals['fetchtype'] = 'SITES'
         sgg = sorted(self.group_groups, key=lambda e: e['subgroup'])
         obj_sgg = sorted(self.gocdbreader.getGroupOfGroups(),
                          key=lambda e: e['subgroup'])
         self.assertEqual(sgg, obj_sgg)
 
+    @mock.patch('modules.input.connection')
+    def testProjectionShared(self, mock_conn):
+        servicelist = dict()
+        mock_conn.__name__ = 'mock_conn'
+        mock_conn.return_value = self.group_endpoints_feed
+        self.mock_conn = mock_conn
+        self.gocdbreader.getServiceEndpoints(servicelist, '&scope=EGI')
+        self.gocdbreader.serviceList['EGI'] = servicelist
+        self.gocdbreader.fetched = True
+        self.gocdbreader.getGroupOfEndpoints.im_func.func_globals['fetchtype'] = 'SITES'
+        first = self.gocdbreader.getGroupOfEndpoints()
+        second = self.gocdbreader.getGroupOfEndpoints()
+        self.assertIsNot(first, second)
+        self.assertEqual(first, second)
+        self.assertIs(first[0], second[0])
+        first.pop()
+        self.assertEqual(len(self.gocdbreader.getGroupOfEndpoints()), len(second))
+        self.assertNotEqual(self.gocdbreader.getGroupOfEndpoints(True), second)
+
+    def testTopoStore(self):
+        store = TopoStore(['EGI', 'Local', 'NoScope'])
+        store['EGI'].update({'1': {'site': 'C'}, '2': {'site': 'A'}})
+        store['Local'].update({'3': {'site': 'B'}, '4': {'site': 'A'}})
+        self.assertEqual(store['NoScope'], {})
+        self.assertEqual(len(list(store.items())), 4)
+        self.assertEqual([(scope, r['site']) for scope, r in store.sorted(key=lambda r: r['site'])],
+                         [('EGI', 'A'), ('Local', 'A'), ('Local', 'B'), ('EGI', 'C')])
+        self.assertIs(store.sorted(key=lambda r: r['site'])[0][1], store['EGI']['2'])
+
+        store = TopoStore(['EGI', 'Local'])
+        shared = {'site': 'A', 'scopes': ['EGI', 'Local', 'wlcg']}
+        store.partition({'1': shared, '2': {'site': 'B', 'scopes': ['local']}})
+        self.assertIs(store['EGI']['1'], store['Local']['1'])
+        self.assertEqual(sorted(store['Local'].keys()), ['1', '2'])
+        self.assertEqual((store.count(), store.unique()), (3, 2))
+
+    def testPushdown(self):
+        siteget = '/gocdbpi/private/?method=get_site'
+        endpointget = '/gocdbpi/private/?method=get_service_endpoint'
+        spellings = {'ngi': ['NGI_HR', 'NGI_IT'], 'site': ['egee.srce.hr'],
+                     'certification': ['Candidate', 'Certified']}
+        critical = ('Sites', {'NGI': 'NGI_HR', 'Certification': ['Certified'], 'Scope': 'EGI'},
+                    {'Monitored': 'Y', 'Production': 'Y'})
+        cloudmon = ('Sites', {'NGI': 'NGI_HR', 'Certification': ['Certified', 'Candidate']},
+                    {'Monitored': 'y'})
+        self.assertEqual(plan_pushdown([critical], spellings),
+                         {siteget: '&certification_status=Certified&roc=NGI_HR',
+                          endpointget: '&monitored=Y'})
+        self.assertEqual(plan_pushdown([critical, cloudmon], spellings),
+                         {siteget: '&roc=NGI_HR', endpointget: '&monitored=Y'})
+        self.assertEqual(plan_pushdown([critical]), {endpointget: '&monitored=Y'})
+        self.assertEqual(plan_pushdown([critical, ('ServiceGroups', {}, {'Monitored': 'Y'})], spellings), {})
+
+        fetched = list()
+        gocdbreader = GOCDBReader('https://localhost/gocdbpi/', set(['EGI']),
+                                  pushdown=plan_pushdown([critical, cloudmon], spellings))
+        gocdbreader.getServiceEndpoints = lambda datalist, scope: fetched.append(('endpoints', scope))
+        gocdbreader.getServiceGroups = lambda datalist, scope: fetched.append(('groups', scope))
+        gocdbreader.getSitesInternal = lambda datalist, scope: fetched.append(('sites', scope))
+        self.assertTrue(gocdbreader.loadDataIfNeeded())
+        self.assertEqual(sorted(fetched), [('endpoints', '&scope=EGI&monitored=Y'),
+                                           ('groups', '&scope=EGI'),
+                                           ('sites', '&scope=EGI&roc=NGI_HR')])
+
+    def testPushdownSpelling(self):
+        siteget = '/gocdbpi/private/?method=get_site'
+        lowercase = ('Sites', {'NGI': 'ngi_hr', 'Site': 'EGEE.SRCE.HR'}, {})
+        unseen = ('Sites', {'NGI': 'ngi_xx'}, {})
+
+        def fetch(datalist, scope):
+            datalist['1'] = {'site': 'egee.srce.hr', 'ngi': 'NGI_HR', 'certification': 'Certified'}
+
+        gocdbreader = GOCDBReader('https://localhost/gocdbpi/', set(['EGI']))
+        self.assertIsNone(gocdbreader.read_spellings())
+        gocdbreader.getSitesInternal = fetch
+        gocdbreader.getServiceEndpoints = gocdbreader.getServiceGroups = lambda datalist, scope: None
+        self.assertTrue(gocdbreader.loadDataIfNeeded())
+        spellings = gocdbreader.read_spellings()
+        self.assertEqual(spellings, {'ngi': ['NGI_HR'], 'site': ['egee.srce.hr'],
+                                     'certification': ['Certified']})
+        self.assertEqual(plan_pushdown([lowercase], spellings),
+                         {siteget: '&roc=NGI_HR&sitename=egee.srce.hr'})
+        self.assertEqual(plan_pushdown([unseen], spellings), {})
+
+        gocdbreader = GOCDBReader('https://localhost/gocdbpi/', set(['EGI']),
+                                  pushdown=plan_pushdown([lowercase], spellings))
+        gocdbreader.getSitesInternal = gocdbreader.getServiceEndpoints = \
+            gocdbreader.getServiceGroups = lambda datalist, scope: None
+        self.assertTrue(gocdbreader.loadDataIfNeeded())
+        self.assertIsNone(gocdbreader.read_spellings())
+
+    def testCombinedScopes(self):
+        globopts = self.globalconfig.parse()
+        globopts['inputstatesavedir'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, globopts['inputstatesavedir'])
+        self.orig_get_rawdata.im_func.func_globals['globopts'] = globopts
+        fetched = list()
+
+        def fetch(datalist, scope):
+            fetched.append(scope)
+            datalist['1'] = {'site': 'A', 'scopes': ['EGI', 'Local']}
+
+        for combined in [False, True]:
+            del fetched[:]
+            gocdbreader = GOCDBReader('https://localhost/gocdbpi/', set(['EGI', 'Local']))
+            gocdbreader.getServiceEndpoints = fetch
+            gocdbreader.getServiceGroups = fetch
+            gocdbreader.getSitesInternal = fetch
+            self.assertEqual(gocdbreader.fetch_combined(), combined)
+            self.assertTrue(gocdbreader.loadDataIfNeeded())
+            self.assertEqual(gocdbreader.read_overlap(), 2.0)
+            self.assertIs(gocdbreader.serviceList['EGI']['1'] is gocdbreader.serviceList['Local']['1'],
+                          combined)
+
+        self.assertEqual(fetched, ['&scope=EGI,Local&scope_match=any'] * 3)
+
+        gocdbreader = GOCDBReader('https://localhost/gocdbpi/', set(['EGI', 'Local']))
+        gocdbreader.getServiceEndpoints = lambda datalist, scope: None
+        gocdbreader.getServiceGroups = lambda datalist, scope: None
+        gocdbreader.getSitesInternal = lambda datalist, scope: None
+        self.assertTrue(gocdbreader.fetch_combined())
+        self.assertTrue(gocdbreader.loadDataIfNeeded())
+        self.assertIsNone(gocdbreader.read_overlap())
+        self.assertFalse(gocdbreader.fetch_combined())
+
+    def testLoadDataConcurrent(self):
+        fetched = list()
+
+        def fetch(datalist, scope):
+            fetched.append(scope)
+
+        def fetch_fail(datalist, scope):
+            raise input.ConnectorError()
+
+        self.gocdbreader.getServiceEndpoints = fetch
+        self.gocdbreader.getServiceGroups = fetch
+        self.gocdbreader.getSitesInternal = fetch
+        self.assertTrue(self.gocdbreader.loadDataIfNeeded())
+        self.assertTrue(self.gocdbreader.fetched)
+        self.assertEqual(sorted(fetched), ['&scope=EGI'] * 3)
+
+        self.gocdbreader.fetched = False
+        self.gocdbreader.getServiceGroups = fetch_fail
+        self.assertFalse(self.gocdbreader.loadDataIfNeeded())
+        self.assertFalse(self.gocdbreader.state)
+        self.assertFalse(self.gocdbreader.fetched)
+
     def testTopoFilter(self):
         groupfilter = {'Monitored': 'Y',
                        'Scope': 'EGI',
@@ -698,6 +919,61 @@ class TopologyXml(unittest.TestCase):
                                            'scope': 'EGI'},
                                   'type': 'SITES'}])
 
+    def testTopoFilterTags(self):
+        logger = mock.Mock(customer='EGI', job='JOB_EGICritical')
+        TopoFilter.filter_tags.im_func.func_globals['logger'] = logger
+        ge = [{'group': 'site%d' % i, 'tags': {'monitored': str(i % 2), 'production': 'Y' if i < 2 else 'N',
+                                              'scope': 'EGI'}}
+              for i in range(4)]
+        tf = TopoFilter([], ge, {}, {'Monitored': 'Y', 'Production': ['y', 'Z'], 'Bogus': 'Y'})
+        self.assertEqual([e['group'] for e in tf.ge], ['site1'])
+        self.assertEqual(logger.error.call_count, 1)
+        self.assertIn('bogus', logger.error.call_args[0][0])
+        tf = TopoFilter([], ge, {}, {'Monitored': ['N', 'Y'], 'Scope': 'egi'})
+        self.assertEqual(tf.ge, ge)
+
+    def testTopoIndex(self):
+        TopoFilter.filter_tags.im_func.func_globals['logger'] = mock.Mock()
+        for gg, ge, ggfilter, gefilter in [(self.group_groups_servicegroup_filter,
+                                            self.group_endpoints_servicegroup_filter,
+                                            {'Monitored': 'Y', 'Scope': 'EGI', 'ServiceGroup': 'SLA_TEST'},
+                                            {'Monitored': 'Y', 'Production': 'Y', 'Scope': 'EGI'}),
+                                           (self.group_groups_sites_filter,
+                                            self.group_endpoints_sites_filter,
+                                            {'Certification': ['Certified', 'Uncertified'], 'Site': 'EGEE.srce.hr'},
+                                            {'Production': 'Y', 'Bogus': 'Y'}),
+                                           (self.group_groups_sites_filter,
+                                            self.group_endpoints_sites_filter,
+                                            {'NGI': 'NGI_NONE'}, {})]:
+            scanned = TopoFilter(gg, ge, ggfilter, gefilter)
+            indexed = TopoFilter(gg, ge, ggfilter, gefilter, TopoIndex(gg), TopoIndex(ge))
+            self.assertEqual(scanned.gg, indexed.gg)
+            self.assertEqual(scanned.ge, indexed.ge)
+
+    def testDedupEndpoints(self):
+        tagnames = ('scope', 'monitored', 'production')
+        fields = dict(type='SITES', group='SRCE', service='CREAM-CE', group_monitored=None)
+        ge = [GroupOfEndpoints(tagnames, ('EGI', '1', '1'), hostname='cream.egi.cro-ngi.hr', **fields),
+              GroupOfEndpoints(tagnames, ('EGI', '1', '1'), hostname='ce.srce.hr', **fields),
+              GroupOfEndpoints(tagnames, ('Local', '1', '1'), hostname='cream.egi.cro-ngi.hr', **fields),
+              GroupOfEndpoints(tagnames, ('Local', '0', '1'), hostname='ce.srce.hr', **fields)]
+        deduped = dedup_endpoints(ge)
+        self.assertEqual([(e['hostname'], e['tags']['scope']) for e in deduped],
+                         [('cream.egi.cro-ngi.hr', 'EGI,Local'),
+                          ('ce.srce.hr', 'EGI'), ('ce.srce.hr', 'Local')])
+        self.assertEqual(deduped[0]['tags']['monitored'], '1')
+        self.assertEqual(dedup_endpoints(ge[:2]), ge[:2])
+
+    def testInterned(self):
+        interned = GroupOfEndpoints.__init__.im_func.func_globals['_interned']
+        tagnames = ('scope', 'monitored', 'info.URL')
+        url = ''.join(['https://', 'eosc.example.org/', 'service'])
+        first = GroupOfEndpoints(tagnames, (''.join(['EO', 'SC']), 'Y', url), type='SERVICEGROUPS')
+        second = GroupOfEndpoints(tagnames, (''.join(['EO', 'SC']), 'Y', url), type='SERVICEGROUPS')
+        self.assertIs(first['tags']['scope'], second['tags']['scope'])
+        self.assertIs(first['tags']['info.URL'], url)
+        self.assertNotIn(url, interned)
+
 
 class WeightsJson(unittest.TestCase):
     def setUp(self):
@@ -708,6 +984,9 @@ class WeightsJson(unittest.TestCase):
                   'jobdir', 'weights', 'weights_feed']:
             code = """self.%s = self.connset.%s""" % (c, c)
             exec code
+        VaporReader.getWeights.im_func.func_globals['input']._flights.clear()
+        self.globopts['inputstatesavedir'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.globopts['inputstatesavedir'])
 
     def wrap_get_weights(self, mock_conn):
         logger = Logger('weights-vapor-connector.py')
@@ -744,6 +1023,9 @@ class DowntimesXml(unittest.TestCase):
                   'jobdir', 'downtimes', 'downtimes_feed']:
             code = """self.%s = self.connset.%s""" % (c, c)
             exec code
+        DowntimesGOCDBReader.getDowntimes.im_func.func_globals['input']._flights.clear()
+        self.globopts['inputstatesavedir'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.globopts['inputstatesavedir'])
 
     def wrap_get_downtimes(self, start, end, mock_conn):
         logger = Logger('downtimes-gocdb-connector.py')
@@ -838,5 +1120,357 @@ class DowntimesXml(unittest.TestCase):
             self.assertTrue('2017_01_19' in call[0])
 
 
+class ConnectionSession(unittest.TestCase):
+    def setUp(self):
+        self.globopts = modules.config.Global(None, 'tests/global.conf').parse()
+        input._sessions.clear()
+
+    def testSessionReuse(self):
+        headers = {'Authorization': 'Basic dXNlcjpwYXNz'}
+        s1 = input.get_session(self.globopts, 'https', 'goc.egi.eu', headers)
+        s2 = input.get_session(self.globopts, 'https', 'goc.egi.eu', dict(headers))
+        self.assertIs(s1, s2)
+        self.assertEqual(s1.cert, (self.globopts['authenticationhostcert'],
+                                   self.globopts['authenticationhostkey']))
+        s3 = input.get_session(self.globopts, 'https', 'goc.egi.eu', {})
+        s4 = input.get_session(self.globopts, 'https', 'operations-portal.egi.eu', headers)
+        self.assertIsNot(s1, s3)
+        self.assertIsNot(s1, s4)
+        self.assertEqual(len(input._sessions), 3)
+
+
+class XmlStream(unittest.TestCase):
+    def setUp(self):
+        self.logger = Logger('downtimes-gocdb-connector.py')
+        self.logger.customer = 'EGI'
+        self.logger.job = 'JOB_EGICritical'
+
+    def testParseWhileDownloading(self):
+        feed = '<results>' + ''.join(['<DOWNTIME PRIMARY_KEY="%dG0"><HOSTNAME>host%d</HOSTNAME></DOWNTIME>' % (i, i)
+                                      for i in range(5000)]) + '</results>'
+        transferred = list()
+
+        class Response(object):
+            def iter_content(self, chunk_size):
+                for i in range(0, len(feed), chunk_size):
+                    transferred.append(i)
+                    yield feed[i:i + chunk_size]
+
+            def close(self):
+                pass
+
+        records = input.parse_xml_records(self.logger, 'GOCDBReader', {}, input.ResponseStream(Response(), 1024),
+                                          'https://localhost/gocdbpi/', 'DOWNTIME',
+                                          lambda e: (e.get('PRIMARY_KEY'), e.find('HOSTNAME').text))
+        self.assertEqual(next(records), ('0G0', 'host0'))
+        self.assertLess(len(transferred) * 1024, len(feed))
+        self.assertEqual(list(records), [('%dG0' % i, 'host%d' % i) for i in range(1, 5000)])
+
+        records = input.parse_xml_records(self.logger, 'GOCDBReader', {}, feed[:-20],
+                                          'https://localhost/gocdbpi/', 'DOWNTIME', lambda e: e)
+        self.assertRaises(input.ConnectorError, list, records)
+
+    def testRetryBrokenTransfer(self):
+        feed = '<results>' + ''.join(['<DOWNTIME PRIMARY_KEY="%dG0"><HOSTNAME>host%d</HOSTNAME></DOWNTIME>' % (i, i)
+                                      for i in range(100)]) + '</results>'
+        requested = list()
+
+        class Response(object):
+            def __init__(self, broken):
+                self.broken = broken
+
+            def iter_content(self, chunk_size):
+                for i in range(0, len(feed), chunk_size):
+                    if self.broken and i > len(feed) / 2:
+                        raise input.requests.exceptions.ChunkedEncodingError('Connection broken')
+                    yield feed[i:i + chunk_size]
+
+            def close(self):
+                pass
+
+        def fetch():
+            requested.append(True)
+            res = input.ResponseStream(Response(len(requested) == 1), 256)
+            return list(input.parse_xml_records(self.logger, 'GOCDBReader', {}, res, 'https://localhost/gocdbpi/',
+                                                'DOWNTIME', lambda e: e.get('PRIMARY_KEY')))
+
+        globopts = {'connectionretry': '1', 'connectionsleepretry': '0'}
+        records = input.fetch_streamed(self.logger, 'GOCDBReader', globopts, fetch)
+        self.assertEqual(records, ['%dG0' % i for i in range(100)])
+        self.assertEqual(len(requested), 2)
+
+        def malformed():
+            requested.append(True)
+            return list(input.parse_xml_records(self.logger, 'GOCDBReader', {}, feed[:-20],
+                                                'https://localhost/gocdbpi/', 'DOWNTIME', lambda e: e))
+
+        self.assertRaises(input.ConnectorError, input.fetch_streamed, self.logger, 'GOCDBReader', globopts, malformed)
+        self.assertEqual(len(requested), 3)
+
+
+class ParserBackend(unittest.TestCase):
+    def setUp(self):
+        self.logger = Logger('topology-gocdb-connector.py')
+        self.logger.customer = 'EGI'
+        self.logger.job = 'JOB_EGICritical'
+        self.connset = ConnectorSetup('downtimes-gocdb-connector.py',
+                                      'tests/global.conf',
+                                      'tests/customer.conf')
+
+    def testBackends(self):
+        parsed = list()
+        for backend in ['stdlib', 'auto']:
+            globopts = {'parserbackend': backend}
+            records = input.parse_xml_records(self.logger, 'GOCDBReader', globopts,
+                                              self.connset.downtimes_feed, 'get_downtime', 'DOWNTIME',
+                                              lambda e: (e.get('PRIMARY_KEY'), e.find('HOSTNAME').text))
+            root = input.parse_xml(self.logger, 'GOCDBReader', globopts,
+                                   self.connset.downtimes_feed, 'get_downtime')
+            doc = input.parse_json(self.logger, 'Vapor', globopts,
+                                   '[{"ngi": "NGI_HR", "site": [{"id": "egee.srce.hr"}]}]', 'vapor')
+            parsed.append((list(records), root.tag, len(root), doc))
+            self.assertRaises(input.ConnectorError, input.parse_xml, self.logger, 'GOCDBReader',
+                              globopts, 'Erroneous XML feed', 'get_downtime')
+            self.assertRaises(input.ConnectorError, input.parse_json, self.logger, 'Vapor',
+                              globopts, 'Erroneous JSON feed', 'vapor')
+
+        self.assertEqual(parsed[0], parsed[1])
+        self.assertEqual(len(parsed[0][0]), 3)
+
+    def testExternalEntity(self):
+        secretdir = tempfile.mkdtemp()
+        try:
+            secret = os.path.join(secretdir, 'secret.txt')
+            with open(secret, 'w') as fp:
+                fp.write('SECRET')
+            feed = ('<?xml version="1.0"?><!DOCTYPE results [<!ENTITY x SYSTEM "file://%s">]>'
+                    '<results><SITE NAME="site"><ROC>&x;</ROC></SITE></results>' % secret)
+            for backend in ['stdlib', 'auto']:
+                globopts = {'parserbackend': backend}
+                try:
+                    records = list(input.parse_xml_records(self.logger, 'GOCDBReader', globopts, feed,
+                                                           'get_site', 'SITE', lambda e: e.find('ROC').text))
+                    root = input.parse_xml(self.logger, 'GOCDBReader', globopts, feed, 'get_site')
+                except input.ConnectorError:
+                    continue
+                self.assertNotIn('SECRET', repr(records))
+                self.assertNotIn('SECRET', repr(root.find('SITE').find('ROC').text))
+        finally:
+            shutil.rmtree(secretdir)
+
+
+class JsonStream(unittest.TestCase):
+    def setUp(self):
+        self.logger = Logger('weights-vapor-connector.py')
+        self.logger.customer = 'EGI'
+        self.logger.job = 'JOB_EGICritical'
+
+    def testIncrementalArray(self):
+        feed = [{'ngi': 'NGI_%d' % i, 'site': [{'id': 'site%d' % i, 'ComputationPower': str(i),
+                                                'Description': 'x' * 100}]}
+                for i in range(3000)] + [12345, u'\u0161']
+        buf = input.BytesIO(json.dumps(feed))
+        read = list()
+        orig_read = buf.read
+
+        def counted_read(size):
+            read.append(size)
+            return orig_read(size)
+
+        buf.read = counted_read
+        records = input.parse_json_records(self.logger, 'Vapor', {}, buf, 'vapor',
+                                           lambda e: e['site'][0]['id'] if isinstance(e, dict) else e)
+        self.assertEqual(next(records), 'site0')
+        self.assertEqual(len(read), 1)
+        self.assertEqual(list(records), ['site%d' % i for i in range(1, 3000)] + [12345, u'\u0161'])
+
+        for erroneous in ['Erroneous JSON feed', '{"ngi": "NGI_HR"}', '[{"ngi": "NGI_HR"}, {"ngi"']:
+            records = input.parse_json_records(self.logger, 'Vapor', {}, erroneous, 'vapor', lambda e: e)
+            self.assertRaises(input.ConnectorError, list, records)
+
+
+class ResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.logger = Logger('topology-gocdb-connector.py')
+        self.logger.customer = 'EGI'
+        self.logger.job = 'JOB_EGICritical'
+        self.globopts = modules.config.Global(None, 'tests/global.conf').parse()
+        self.globopts['inputstatesavedir'] = tempfile.mkdtemp()
+        self.feed = '<results><SITE NAME="sitename"/></results>'
+
+    def tearDown(self):
+        shutil.rmtree(self.globopts['inputstatesavedir'])
+
+    def response(self, status, content='', headers={}):
+        response = mock.Mock(status_code=status, content=content, headers=headers)
+        response.iter_content.return_value = iter([content[:10], content[10:]])
+        return response
+
+    @mock.patch('modules.input.get_session')
+    def testConditionalRequest(self, get_session):
+        session = get_session.return_value
+        session.get.side_effect = [self.response(200, self.feed, {'etag': '"v1"'}),
+                                   self.response(304),
+                                   self.response(304),
+                                   self.response(200, self.feed, {})]
+        args = (self.logger, 'GOCDBReader', self.globopts, 'http', 'goc.egi.eu',
+                '/gocdbpi/?method=get_site')
+
+        self.assertEqual(input.connection(*args), self.feed)
+        self.assertEqual(session.get.call_args[1]['headers'], {})
+        self.assertEqual(input.connection(*args), self.feed)
+        self.assertEqual(session.get.call_args[1]['headers'], {'If-None-Match': '"v1"'})
+        buf = input.connection(*args, stream=True)
+        self.assertEqual(buf.read(), self.feed)
+        buf.close()
+        self.assertEqual(input.connection(*args), self.feed)
+        self.assertEqual(session.get.call_count, 4)
+
+        cache = input.ResponseCache(self.globopts, 'http://goc.egi.eu/gocdbpi/?method=get_site', {})
+        self.assertEqual(cache.validators(), {})
+
+    @mock.patch('modules.input.get_session')
+    def testStreamedResponseStored(self, get_session):
+        session = get_session.return_value
+        session.get.side_effect = [self.response(200, self.feed, {'last-modified': 'Mon, 15 Oct 2018 10:00:00 GMT'}),
+                                   self.response(304)]
+        args = (self.logger, 'GOCDBReader', self.globopts, 'http', 'goc.egi.eu',
+                '/gocdbpi/?method=get_site')
+
+        self.assertEqual(input.connection(*args, stream=True).read(), self.feed)
+        self.assertEqual(input.connection(*args), self.feed)
+        self.assertEqual(session.get.call_args[1]['headers'],
+                         {'If-Modified-Since': 'Mon, 15 Oct 2018 10:00:00 GMT'})
+
+    @mock.patch('modules.input.get_session')
+    def testStreamClosedOnError(self, get_session):
+        session = get_session.return_value
+        feed = '<results>' + '<SITE NAME="sitename"/>' * 100000 + '</results>'
+        response = self.response(200, feed, {'etag': '"v1"'})
+        response.iter_content.return_value = iter([feed[i:i + 1024] for i in range(0, len(feed), 1024)])
+        session.get.side_effect = [response]
+
+        def extract(elem):
+            raise AttributeError('extract')
+
+        buf = input.connection(self.logger, 'GOCDBReader', self.globopts, 'http', 'goc.egi.eu',
+                               '/gocdbpi/?method=get_site', stream=True)
+        records = input.parse_xml_records(self.logger, 'GOCDBReader', self.globopts, buf,
+                                          'get_site', 'SITE', extract)
+        self.assertRaises(AttributeError, list, records)
+        self.assertTrue(response.close.called)
+        responses = os.path.join(self.globopts['inputstatesavedir'], 'responses')
+        self.assertEqual(os.listdir(responses), [])
+
+    @mock.patch('modules.input.get_session')
+    def testEmptyStreamRetried(self, get_session):
+        session = get_session.return_value
+        session.get.side_effect = [self.response(200, '', {'etag': '"v1"'}),
+                                   self.response(200, self.feed, {'etag': '"v2"'})]
+        self.globopts['connectionsleepretry'] = '0'
+
+        buf = input.connection(self.logger, 'GOCDBReader', self.globopts, 'http', 'goc.egi.eu',
+                               '/gocdbpi/?method=get_site', stream=True)
+        self.assertEqual(buf.read(), self.feed)
+        self.assertEqual(session.get.call_count, 2)
+
+    @mock.patch('modules.input.get_session')
+    def testCacheUnavailable(self, get_session):
+        session = get_session.return_value
+        session.get.side_effect = [self.response(200, self.feed, {'etag': '"v1"'})]
+        savedir = os.path.join(self.globopts['inputstatesavedir'], 'file')
+        open(savedir, 'w').close()
+        self.globopts['inputstatesavedir'] = savedir
+
+        try:
+            buf = input.connection(self.logger, 'GOCDBReader', self.globopts, 'http', 'goc.egi.eu',
+                                   '/gocdbpi/?method=get_site', stream=True)
+            self.assertEqual(buf.read(), self.feed)
+            self.assertEqual(session.get.call_args[1]['headers'], {})
+        finally:
+            self.globopts['inputstatesavedir'] = os.path.dirname(savedir)
+
+    @mock.patch('modules.input.get_session')
+    def testSlotHeldWhileStreaming(self, get_session):
+        session = get_session.return_value
+        session.get.side_effect = [self.response(200, self.feed, {}), self.response(200, self.feed, {})]
+        self.globopts['connectionmaxperhost'] = '1'
+        input._host_slots.pop('slots.egi.eu', None)
+
+        buf = input.connection(self.logger, 'GOCDBReader', self.globopts, 'http', 'slots.egi.eu',
+                               '/gocdbpi/?method=get_site', stream=True)
+        slots = input.get_host_slots(self.globopts, 'slots.egi.eu')
+        self.assertFalse(slots.acquire(False))
+        buf.close()
+        self.assertTrue(slots.acquire(False))
+        slots.release()
+
+        self.assertEqual(input.connection(self.logger, 'GOCDBReader', self.globopts, 'http', 'slots.egi.eu',
+                                          '/gocdbpi/?method=get_site'), self.feed)
+        self.assertTrue(slots.acquire(False))
+        slots.release()
+
+    def testPruned(self):
+        cache = input.ResponseCache(self.globopts, 'http://goc.egi.eu/gocdbpi/?method=get_downtime', {})
+        for f in [cache.meta, cache.body]:
+            with open(f, 'w') as fp:
+                fp.write('{}')
+        fresh = input.ResponseCache(self.globopts, 'http://goc.egi.eu/gocdbpi/?method=get_site', {})
+        with open(fresh.body, 'w') as fp:
+            fp.write(self.feed)
+        old = time.time() - (int(self.globopts['inputstatedays']) + 1) * 24 * 3600
+        os.utime(cache.meta, (old, old))
+        os.utime(cache.body, (old, old))
+
+        input._pruned.clear()
+        input.ResponseCache(self.globopts, 'http://goc.egi.eu/gocdbpi/?method=get_site', {})
+        self.assertFalse(os.path.exists(cache.meta))
+        self.assertFalse(os.path.exists(cache.body))
+        self.assertTrue(os.path.exists(fresh.body))
+
+
+class SingleFlight(unittest.TestCase):
+    def setUp(self):
+        input._flights.clear()
+
+    def testFetchedOnce(self):
+        started, release = threading.Event(), threading.Event()
+        calls = list()
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return ['fetched']
+
+        results = list()
+        key = input.request_key({}, 'https', 'operations-portal.egi.eu', '/vapor/')
+        threads = [threading.Thread(target=lambda: results.append(input.single_flight(key, fetch)))
+                   for i in range(4)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['fetched']] * 4)
+        self.assertIs(input.single_flight(key, fetch), results[0])
+        self.assertEqual(len(calls), 1)
+
+        authkey = input.request_key({}, 'https', 'operations-portal.egi.eu', '/vapor/',
+                                    {'authenticationhttpuser': 'user'})
+        self.assertNotEqual(key, authkey)
+
+    def testFailureNotKept(self):
+        def fail():
+            raise input.ConnectorError()
+
+        self.assertRaises(input.ConnectorError, input.single_flight, 'key', fail)
+        self.assertEqual(input.single_flight('key', lambda: 'fetched'), 'fetched')
+
+
 if __name__ == '__main__':
     unittest.main()
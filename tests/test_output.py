@@ -3,14 +3,22 @@ import httplib
 import json
 import mock
 import modules.config
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest2 as unittest
 
+from avro.datafile import DataFileReader
+from avro.io import DatumReader
+
 from httmock import urlmatch, HTTMock, response
 
 from bin.topology_gocdb_connector import logger
 from modules import output
 from modules import input
-from modules.helpers import datestamp, filename_date, retry
+from modules.helpers import datestamp, filename_date, retry, GroupOfEndpoints
 
 
 class ConnectorSetup(object):
@@ -134,6 +142,24 @@ class TopologyAvro(unittest.TestCase):
         self.assertEqual(mock_avrofile.append.mock_calls.index(mock.call(self.group_endpoints[1])), 1)
         self.assertEqual(mock_avrofile.append.mock_calls.index(mock.call(self.group_endpoints[2])), 2)
 
+    @mock.patch('modules.output.load_schema')
+    @mock.patch('modules.output.open')
+    def testCompactGroupEndpoints(self, mock_open, mock_lschema):
+        mock_avrofile = mock.create_autospec(output.DataFileWriter)
+        filename = filename_date(logger, self.globopts['OutputTopologyGroupOfEndpoints'.lower()], self.jobdir)
+        m = output.AvroWriter(self.globopts['AvroSchemasTopologyGroupOfEndpoints'.lower()], filename)
+        m.datawrite = mock_avrofile
+        tagnames = ('scope', 'monitored', 'production')
+        entities = [GroupOfEndpoints(tagnames, [e['tags'][t] for t in tagnames], type=e['type'],
+                                     group=e['group'], service=e['service'], hostname=e['hostname'])
+                    for e in self.group_endpoints]
+        self.assertIs(entities[0]['tags']['scope'], entities[1]['tags']['scope'])
+        self.assertIs(entities[0]['group'], entities[1]['group'])
+        m.write(entities)
+        for i, call in enumerate(mock_avrofile.append.mock_calls):
+            self.assertIs(type(call[1][0]), dict)
+            self.assertEqual(call[1][0], self.group_endpoints[i])
+
 
 class DowntimesAvro(unittest.TestCase):
     def setUp(self):
@@ -602,3 +628,195 @@ class TopologyAms(unittest.TestCase):
                                        'group_endpoints', datestamp().replace('_', '-'), self.group_endpoints)
             self.assertTrue(ret)
 
+    def testEncodedOnce(self):
+        schema = self.globopts['AvroSchemasTopologyGroupOfEndpoints'.lower()]
+        data = output.AvroData(schema, self.group_endpoints)
+        self.assertEqual(len(data), len(self.group_endpoints))
+
+        for ams in [self.amspublish, self.amspublish_pack]:
+            sent = list()
+            with mock.patch.object(output.AmsPublish, '_send') as mock_send:
+                ams.send(schema, 'group_endpoints', datestamp().replace('_', '-'), self.group_endpoints)
+                ams.send(schema, 'group_endpoints', datestamp().replace('_', '-'), data)
+                for call in mock_send.call_args_list:
+                    sent.append([m.dict() for m in call[0][3].msgs])
+            self.assertEqual(sent[0], sent[1])
+
+        avrodir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(avrodir, 'group_endpoints.avro')
+            writer = output.AvroWriter(schema, filename)
+            self.assertIsNone(writer.datawrite)
+            ret, excep = writer.write(data)
+            self.assertTrue(ret)
+            self.assertIsInstance(writer.datawrite.datum_writer, output.RawDatumWriter)
+            with open(filename) as fp:
+                self.assertEqual(list(DataFileReader(fp, DatumReader())), self.group_endpoints)
+        finally:
+            shutil.rmtree(avrodir)
+
+
+class AmsBatches(unittest.TestCase):
+    def setUp(self):
+        self.logger = mock.Mock(customer='EGI', job='JOB_EGICritical')
+        self.amspublish = output.AmsPublish('localhost', 'EGI', 'EGIKEY', 'TOPIC', 'EGI_Critical', 100, 'False',
+                                            self.logger, 2, 180, 0)
+        self.msgs = [output.AmsMessage(attributes={'type': 'weights'}, data='%06d' % i) for i in range(250)]
+
+    def published(self, mock_publish):
+        return [c[0][1] for c in mock_publish.call_args_list]
+
+    def testCoverage(self):
+        self.amspublish.maxinflight = 1
+        batches = output.PublishBatches(self.msgs, 100, output.AMSBULKBYTES, 60)
+        size = batches._sizes[0]
+        with mock.patch.object(self.amspublish.ams, 'publish') as mock_publish:
+            self.assertTrue(self.amspublish._send(self.logger, 'AmsPublish', {'connectionretry': 2, 'connectiontimeout': 180,
+                                                                         'connectionsleepretry': 0}, batches,
+                                                  self.amspublish))
+            self.assertEqual([len(b) for b in self.published(mock_publish)], [100, 100, 50])
+            self.assertEqual(sum(self.published(mock_publish), []), self.msgs)
+
+        batches = output.PublishBatches(self.msgs, 100, size * 30 + 1, 60)
+        with mock.patch.object(self.amspublish.ams, 'publish') as mock_publish:
+            self.amspublish._send(self.logger, 'AmsPublish', {'connectionretry': 2, 'connectiontimeout': 180,
+                                                         'connectionsleepretry': 0}, batches, self.amspublish)
+            self.assertEqual([len(b) for b in self.published(mock_publish)], [30] * 8 + [10])
+            self.assertEqual(sum(self.published(mock_publish), []), self.msgs)
+
+    def testRetryContinues(self):
+        def publish(topic, msgs, timeout):
+            if not failed:
+                failed.append(msgs)
+                raise output.AmsException(500, 'publish')
+
+        failed = list()
+        self.amspublish.maxinflight = 1
+        batches = output.PublishBatches(self.msgs, 100, output.AMSBULKBYTES, 60)
+        with mock.patch.object(self.amspublish.ams, 'publish', side_effect=publish) as mock_publish:
+            self.assertTrue(self.amspublish._send(self.logger, 'AmsPublish', {'connectionretry': 2, 'connectiontimeout': 180,
+                                                                         'connectionsleepretry': 0}, batches,
+                                                  self.amspublish))
+            published = self.published(mock_publish)
+            self.assertEqual([len(b) for b in published], [100, 50, 75, 100, 25])
+            self.assertEqual(sum(published[1:], []), self.msgs)
+
+    def testInFlight(self):
+        def publish(topic, msgs, timeout):
+            with lock:
+                inflight.append(msgs)
+                peak.append(len(inflight))
+            time.sleep(0.01)
+            with lock:
+                inflight.remove(msgs)
+            if msgs[0] is self.msgs[100] and not failed:
+                failed.append(msgs)
+                raise output.AmsException(500, 'publish')
+
+        lock = threading.Lock()
+        inflight, peak, failed = list(), list(), list()
+        batches = output.PublishBatches(self.msgs, 20, output.AMSBULKBYTES, 60)
+        with mock.patch.object(self.amspublish.ams, 'publish', side_effect=publish) as mock_publish:
+            self.assertTrue(self.amspublish._send(self.logger, 'AmsPublish', {'connectionretry': 2,
+                                                                              'connectiontimeout': 180,
+                                                                              'connectionsleepretry': 0},
+                                                  batches, self.amspublish))
+            published = self.published(mock_publish)
+            published.remove(failed[0])
+            self.assertEqual(sorted(sum(published, []), key=self.msgs.index), self.msgs)
+            self.assertEqual(len(sum(published, [])), len(self.msgs))
+        self.assertLessEqual(max(peak), output.AMSMAXINFLIGHT)
+        self.assertEqual(self.logger.warn.call_count, 2)
+
+    def testLedger(self):
+        def publish(topic, msgs, timeout):
+            calls.append(msgs)
+            if len(calls) > 1:
+                raise output.AmsException(500, 'publish')
+            return {'messageIds': [str(i) for i in range(len(msgs))]}
+
+        calls = list()
+
+        statedir = tempfile.mkdtemp()
+        try:
+            weights = [{'site': 'SITE%d' % i, 'type': 'hepspec', 'weight': str(i)} for i in range(250)]
+            self.amspublish.statedir = statedir
+            self.amspublish.retry = 0
+            self.amspublish.maxinflight = 1
+            with mock.patch.object(self.amspublish.ams, 'publish', side_effect=publish) as mock_publish:
+                self.assertFalse(self.amspublish.send('etc/schemas/weight_sites.avsc', 'weights',
+                                                      '2017-01-19', weights))
+                self.assertEqual([len(b) for b in self.published(mock_publish)], [100, 100])
+            ledger = os.path.join(statedir, 'ams-weights_2017_01_19')
+            with open(ledger) as fp:
+                self.assertEqual([l.split()[1] for l in fp], [str(i) for i in range(100)])
+
+            stale = os.path.join(statedir, 'ams-group_endpoints_2017_01_15')
+            recent = os.path.join(statedir, 'ams-group_endpoints_2017_01_16')
+            for path in [stale, recent]:
+                open(path, 'w').close()
+            amspublish = output.AmsPublish('localhost', 'EGI', 'EGIKEY', 'TOPIC', 'EGI_Critical', 100, 'False',
+                                           self.logger, 0, 180, 0, statedir=statedir, savedays=3)
+            with mock.patch.object(amspublish.ams, 'publish') as mock_publish:
+                self.assertTrue(amspublish.send('etc/schemas/weight_sites.avsc', 'weights', '2017-01-19', weights))
+                published = self.published(mock_publish)
+                self.assertEqual([len(b) for b in published], [100, 50])
+                self.assertEqual([m.get_data() for m in sum(published, [])],
+                                 output.encode_datums('etc/schemas/weight_sites.avsc', weights[100:]))
+            self.assertFalse(os.path.exists(ledger))
+            self.assertEqual(os.listdir(statedir), [os.path.basename(recent)])
+        finally:
+            shutil.rmtree(statedir)
+
+
+class SchemaRegistry(unittest.TestCase):
+    def setUp(self):
+        self.connset = ConnectorSetup('metricprofile-webapi-connector.py',
+                                      'tests/global.conf',
+                                      'tests/customer.conf')
+        self.schema = self.connset.globopts['AvroSchemasMetricProfile'.lower()]
+        output._schemas.clear()
+
+    @mock.patch('modules.output.avro.schema.parse', wraps=output.avro.schema.parse)
+    def testParsedOnce(self, mock_parse):
+        schema = output.load_schema(self.schema)
+        self.assertIs(output.load_schema(self.schema), schema)
+        self.assertIs(output.datum_writer(self.schema).writers_schema, schema)
+        self.assertEqual(mock_parse.call_count, 1)
+
+    def testEncoderSelection(self):
+        lschema = output.load_schema(self.schema)
+        with mock.patch('modules.output.fastavro', None):
+            self.assertIs(type(output.new_datum_writer(lschema)), output.DatumWriter)
+
+        with mock.patch('modules.output.fastavro') as mock_fastavro:
+            writer = output.new_datum_writer(lschema)
+            self.assertIsInstance(writer, output.FastDatumWriter)
+            encoder = output.BinaryEncoder(output.BytesIO())
+            for elem in self.connset.poem:
+                writer.write(elem, encoder)
+            self.assertEqual(mock_fastavro.parse_schema.call_count, 1)
+            self.assertEqual(mock_fastavro.schemaless_writer.call_count, len(self.connset.poem))
+            bogus = dict(self.connset.poem[0], profile=None)
+            self.assertRaises(output.AvroTypeException, writer.write, bogus, encoder)
+            self.assertEqual(mock_fastavro.schemaless_writer.call_count, len(self.connset.poem))
+
+    @unittest.skipIf(output.fastavro is None, 'fastavro not installed')
+    def testFastEncoder(self):
+        for connector, schema, data in [('metricprofile-webapi-connector.py', 'AvroSchemasMetricProfile', 'poem'),
+                                        ('downtimes-gocdb-connector.py', 'AvroSchemasDowntimes', 'downtimes'),
+                                        ('weights-vapor-connector.py', 'AvroSchemasWeights', 'weights'),
+                                        ('topology-gocdb-connector.py', 'AvroSchemasTopologyGroupOfGroups',
+                                         'group_groups'),
+                                        ('topology-gocdb-connector.py', 'AvroSchemasTopologyGroupOfEndpoints',
+                                         'group_endpoints')]:
+            connset = ConnectorSetup(connector, 'tests/global.conf', 'tests/customer.conf')
+            lschema = output.load_schema(connset.globopts[schema.lower()])
+            encoded = list()
+            for writer in [output.DatumWriter(lschema), output.FastDatumWriter(lschema)]:
+                bytesio = output.BytesIO()
+                encoder = output.BinaryEncoder(bytesio)
+                for elem in getattr(connset, data):
+                    writer.write(elem, encoder)
+                encoded.append(bytesio.getvalue())
+            self.assertEqual(encoded[0], encoded[1])